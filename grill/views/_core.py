@@ -99,10 +99,12 @@ def _which(what):
     return shutil.which(what)
 
 
-def _run(args: list):
+def _run(args: list, stdin: typing.Optional[str] = None):
     if not args or not args[0]:
         raise ValueError(f"Expected arguments to contain an executable value on the first index. Got: {args}")
     kwargs = dict(capture_output=True)
+    if stdin is not None:
+        kwargs.update(input=stdin.encode())
     if hasattr(subprocess, 'CREATE_NO_WINDOW'):  # Only on Windows OS
         kwargs.update(creationflags=subprocess.CREATE_NO_WINDOW)
     try:
@@ -133,6 +135,21 @@ def wait():
         QtWidgets.QApplication.restoreOverrideCursor()
 
 
+def _run_holding_user_input(threadpool: QtCore.QThreadPool, runnable: QtCore.QRunnable, finished):
+    """Run runnable on threadpool, processing all events except user input until finished is emitted.
+
+    USD stages are not safe to read and write at the same time. Holding user input while a runnable reads a stage
+    keeps the GUI from editing it meanwhile, while widgets keep painting.
+
+    Only user input is held: timers, posted events and host application callbacks keep being processed, so stage
+    edits coming from those can still happen while the runnable reads it.
+    """
+    loop = QtCore.QEventLoop()
+    finished.connect(loop.quit)  # queued, so it is not missed if emitted before the loop starts
+    threadpool.start(runnable)
+    loop.exec_(QtCore.QEventLoop.ExcludeUserInputEvents)
+
+
 class _EMOJI(enum.Enum):  # Replace with StrEnum in 3.11
     # All emojis have an additional space at the end since Maya-2023.2 and Houdini-19.5 are unable to display emoji otherwise
     # GENERAL
@@ -2,14 +2,21 @@
 from __future__ import annotations
 
 import os
+import re
 import math
+import time
+import hashlib
 import typing
+import weakref
 import logging
 import tempfile
+import threading
+import itertools
 import configparser
 import networkx as nx
+from pathlib import Path
 from itertools import chain
-from functools import cache
+from functools import cache, lru_cache
 
 from networkx import drawing
 
@@ -25,11 +32,13 @@ _env_config.read_dict(
         "graph_view": {
             "via_svg": os.environ.get("GRILL_GRAPH_VIEW_VIA_SVG", 0),
             "svg_as_pixmap": os.environ.get("GRILL_SVG_VIEW_AS_PIXMAP", 0),
+            "svg_cache": os.environ.get("GRILL_SVG_CACHE", 1),
         }
     }
 )
 _GRAPHV_VIEW_VIA_SVG = _env_config.getboolean('graph_view', 'via_svg')
 _USE_SVG_VIEWPORT = _env_config.getboolean('graph_view', 'svg_as_pixmap')
+_USE_SVG_CACHE = _env_config.getboolean('graph_view', 'svg_cache')
 
 _IS_QT5 = QtCore.qVersion().startswith("5")
 
@@ -45,6 +54,15 @@ _IS_QT5 = QtCore.qVersion().startswith("5")
 
 
 _NO_PEN = QtGui.QPen(QtCore.Qt.NoPen)
+_NON_DOT_ATTRS = frozenset({"plugs", "active_plugs"})  # used by _Node only, graphviz does not need them
+_SET_CONTENT_LIMIT = 2 * 1024 * 1024  # QWebEngineView.setContent does not display content larger than 2 MB
+_SVG_CACHE_LIMIT = 200 * 1024 * 1024  # svgs rendered on previous sessions, least recently used are pruned past this
+_SVG_CACHE_TMP_AGE = 60 * 60  # seconds after which partially written svgs are considered left by interrupted sessions
+
+# Graphs are not modified once they're handed to a viewer, so their adjacency is computed only once.
+_ADJACENCY_BY_GRAPH = weakref.WeakKeyDictionary()  # {nx.Graph: ({node: (successor,)}, {node: (predecessor,)})}
+# graphviz's C library is not thread safe, and svgs are rendered from a thread pool.
+_AGRAPH_LOCK = threading.Lock()
 
 _DOT_ENVIRONMENT_ERROR = """In order to display composition arcs in a graph,
 the 'dot' command must be available on the current environment.
@@ -74,15 +92,193 @@ def _convert_graphviz_to_html_label(label):
     return label
 
 
-@cache
+def _adjacency(graph: nx.DiGraph) -> tuple[dict, dict]:
+    """Successors and predecessors of every node in the graph."""
+    try:
+        return _ADJACENCY_BY_GRAPH[graph]
+    except KeyError:
+        adjacency = _ADJACENCY_BY_GRAPH[graph] = (
+            {node: tuple(graph.successors(node)) for node in graph},
+            {node: tuple(graph.predecessors(node)) for node in graph},
+        )
+        return adjacency
+
+
+def _dot_quote(value) -> str:
+    text = str(value)
+    if text.startswith("<") and text.endswith(">"):  # HTML-like labels are written as they are
+        return text
+    return '"' + text.replace('"', r'\"') + '"'
+
+
+def _dot_attrs(attrs: typing.Mapping) -> str:
+    return ", ".join(f"{key}={_dot_quote(value)}" for key, value in attrs.items() if key not in _NON_DOT_ATTRS)
+
+
+def _dot_source(graph: nx.Graph) -> str:
+    """DOT text for the given graph, without a pygraphviz / pydot round-trip.
+
+    Follows the networkx-to-graphviz convention: the "graph", "node" and "edge" entries of the graph's
+    attributes are the defaults for those elements; any other entry is a graph attribute.
+    """
+    directed = graph.is_directed()
+    connector = "->" if directed else "--"
+    lines = ["digraph {" if directed else "graph {"]
+    for element in ("graph", "node", "edge"):
+        if defaults := graph.graph.get(element):
+            lines.append(f"\t{element} [{_dot_attrs(defaults)}];")
+    if attrs := {key: value for key, value in graph.graph.items() if key not in ("graph", "node", "edge")}:
+        lines.append(f"\tgraph [{_dot_attrs(attrs)}];")
+    lines.extend(f"\t{_dot_quote(node)} [{_dot_attrs(attrs)}];" for node, attrs in graph.nodes(data=True))
+    lines.extend(f"\t{_dot_quote(source)} {connector} {_dot_quote(target)} [{_dot_attrs(attrs)}];" for source, target, attrs in graph.edges(data=True))
+    lines.append("}")
+    return "\n".join(lines)
+
+
 def _dot_2_svg(sourcepath):
-    print(f"Creating svg for: {sourcepath}")
+    try:
+        stat = os.stat(sourcepath)
+    except OSError:
+        file_state = None
+    else:  # a file re-written on the same path should not get a previous svg
+        file_state = (stat.st_mtime_ns, stat.st_size)
+    return _dot_file_2_svg(sourcepath, file_state)
+
+
+@lru_cache(maxsize=256)
+def _dot_file_2_svg(sourcepath, file_state):
+    _logger.debug("Creating svg for: %s", sourcepath)
     targetpath = f"{sourcepath}.svg"
-    args = [_core._which("dot"), sourcepath, "-Tsvg", "-o", targetpath]
-    error, __ = _core._run(args)
+    if _agraph_cls():
+        error, __ = _agraph_2_svg(targetpath, filename=sourcepath)
+    else:
+        error, __ = _core._run([_core._which("dot"), sourcepath, "-Tsvg", "-o", targetpath])
     return error, targetpath
 
 
+@lru_cache(maxsize=64)
+def _dot_source_2_svg(source: str):
+    """Same as _dot_2_svg but piping source DOT text through dot's stdin and reading the svg from its stdout."""
+    if cache_dir := _svg_cache_dir():
+        digest = hashlib.blake2b(_svg_renderer().encode(), digest_size=16)  # other renderers produce other svgs
+        digest.update(source.encode())
+        cached = cache_dir / f"{digest.hexdigest()}.svg"
+        try:
+            svg = cached.read_text()
+        except OSError:
+            pass  # not rendered before
+        else:
+            os.utime(cached)  # recently used, keep it when pruning
+            return None, svg
+
+    if _agraph_cls():
+        error, svg = _agraph_2_svg(string=source)
+    else:
+        error, svg = _core._run([_core._which("dot"), "-Tsvg"], stdin=source)
+
+    if cache_dir and not error:
+        # write aside and move, so other threads or sessions never read a partially written svg
+        partial = cached.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            partial.write_text(svg)
+            os.replace(partial, cached)
+        except OSError as exc:
+            _logger.debug("Could not cache svg on %s: %s", cached, exc)
+    return error, svg
+
+
+@cache
+def _svg_cache_dir():
+    """Directory of svgs rendered from DOT sources, shared between sessions. None when GRILL_SVG_CACHE is disabled."""
+    if not _USE_SVG_CACHE:
+        return None
+    location = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.GenericCacheLocation)
+    if not location:
+        return None
+    cache_dir = Path(location) / "grill" / "svg"
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    _prune_svg_cache(cache_dir, _SVG_CACHE_LIMIT)
+    return cache_dir
+
+
+@cache
+def _svg_renderer() -> str:
+    """Program rendering svgs and its graphviz version, as reported on the svgs it renders."""
+    empty_graph = "digraph {}"
+    if _agraph_cls():
+        renderer = "pygraphviz"
+        __, svg = _agraph_2_svg(string=empty_graph)
+    else:
+        renderer = "dot"
+        __, svg = _core._run([_core._which("dot"), "-Tsvg"], stdin=empty_graph)
+    version = re.search(r"Generated by graphviz version ([^\n]+)", svg)  # e.g. 12.2.1 (20241206.2353)
+    return f"{renderer} {version.group(1).strip() if version else ''}"
+
+
+def _prune_svg_cache(cache_dir: Path, limit: int):
+    """Remove least recently used svgs from cache_dir until their total size is below limit (in bytes).
+
+    Partial svgs left by interrupted writes are removed as well.
+    """
+    expired = time.time() - _SVG_CACHE_TMP_AGE  # newer ones might still be written by other sessions
+    for path in cache_dir.glob("*.tmp"):
+        try:
+            if path.stat().st_mtime < expired:
+                path.unlink(missing_ok=True)
+        except OSError:  # removed or in use by another session
+            continue
+    stats = []
+    for path in cache_dir.glob("*.svg"):
+        try:
+            stats.append((path.stat(), path))
+        except OSError:  # removed by another session
+            continue
+    total = 0
+    for stat, path in sorted(stats, key=lambda item: item[0].st_mtime, reverse=True):
+        total += stat.st_size
+        if total > limit:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as exc:  # e.g. in use by another session on Windows
+                _logger.debug("Could not prune %s: %s", path, exc)
+
+
+@cache
+def _agraph_cls():
+    """pygraphviz's AGraph, when available, renders through graphviz's C library without a dot process per graph."""
+    try:
+        from pygraphviz import AGraph
+    except ImportError:
+        return None
+    return AGraph
+
+
+def _agraph_2_svg(path=None, **agraph_kwargs):
+    """In-process counterpart of running dot -Tsvg. Returns (error, svg), with an empty svg when written to path."""
+    with _AGRAPH_LOCK:
+        try:
+            result = _agraph_cls()(**agraph_kwargs).draw(path, format="svg", prog="dot")
+        except (ValueError, OSError) as exc:  # pygraphviz.DotError is a ValueError
+            return str(exc), ""
+    return None, result.decode() if result else ""
+
+
+def _kept_edges(view) -> frozenset:
+    """Edges of view's graph passing its edge filter, swept again only after its graph, filter or sticky nodes change."""
+    graph, predicate = view.graph, view.filter_edges
+    # sticky nodes are edited in place, so compare their contents instead of the list
+    key = (graph, predicate, tuple(view.sticky_nodes))
+    cached_key, kept = view._kept_edges_cache
+    if cached_key != key:
+        edges = graph.edges(keys=True) if graph.is_multigraph() else graph.edges
+        kept = frozenset(edge for edge in edges if predicate(*edge))
+        view._kept_edges_cache = key, kept  # on the view, so graphs are not kept alive after it moves on
+    return kept
+
+
 class _Node(QtWidgets.QGraphicsTextItem):
 
     def __init__(self, parent=None, label="", color="", fillcolor="", plugs: tuple =None, active_plugs: set = frozenset(), visible=True):
@@ -525,6 +721,7 @@ class GraphView(_GraphicsViewport):
 
         self.sticky_nodes = list()
         self._viewing = set()
+        self._kept_edges_cache = (None, frozenset())
         self.url_id_prefix = ""
 
     def _graph_url_changed(self, *_, **__):
@@ -540,16 +737,14 @@ class GraphView(_GraphicsViewport):
         graph = self._graph
         if not graph:
             return
-        successors = chain.from_iterable(graph.successors(index) for index in node_indices)
-        predecessors = chain.from_iterable(graph.predecessors(index) for index in node_indices)
-        nodes_of_interest = chain(self.sticky_nodes, node_indices, successors, predecessors)
+        successors, predecessors = _adjacency(graph)
+        neighbours = chain.from_iterable(chain(successors[index], predecessors[index]) for index in node_indices)
+        nodes_of_interest = chain(self.sticky_nodes, node_indices, neighbours)
         subgraph = graph.subgraph(nodes_of_interest)
 
-        filters = {}
         if self.filter_edges:
-            filters['filter_edge'] = self.filter_edges
-        if filters:
-            subgraph = nx.subgraph_view(subgraph, **filters)
+            kept = _kept_edges(self)
+            subgraph = nx.subgraph_view(subgraph, filter_edge=lambda *edge: edge in kept)
 
         self._load_graph(subgraph)
 
@@ -565,7 +760,6 @@ class GraphView(_GraphicsViewport):
     def filter_edges(self, value):
         if value == self._filter_edges:
             return
-        # self._subgraph_dot_path.cache_clear()
         if value:
             predicate = lambda *edge: value(*edge) or bool({edge[0], edge[1]}.intersection(self.sticky_nodes))
         else:
@@ -601,7 +795,7 @@ class GraphView(_GraphicsViewport):
             self.scene().addItem(text_item)
             return
 
-        print("LOADING GRAPH")
+        _logger.debug("Loading graph: %s", graph)
         self._nodes_map.clear()
         edge_color = graph.graph.get('edge', {}).get("color", "")
 
@@ -653,12 +847,27 @@ class GraphView(_GraphicsViewport):
             self.scene().addItem(edge)
 
 
+@cache
+def _dot_threadpool():
+    """Pool shared by all dot viewers, so that many of them at once don't oversubscribe the CPU.
+
+    A dedicated pool instead of QThreadPool.globalInstance, since that one might be in use by host applications.
+    """
+    pool = QtCore.QThreadPool()
+    pool.setMaxThreadCount(min(4, QtCore.QThread.idealThreadCount()))
+    return pool
+
+
 class _Dot2SvgSignals(QtCore.QObject):
     error = QtCore.Signal(str)
     result = QtCore.Signal(str)
+    finished = QtCore.Signal()  # after either error or result
 
 
 class _Dot2Svg(QtCore.QRunnable):
+    """Converts the DOT file at source_fp, emitting the path of the resulting svg file."""
+    _convert = staticmethod(_dot_2_svg)
+
     def __init__(self, source_fp, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.signals = _Dot2SvgSignals()
@@ -666,11 +875,19 @@ class _Dot2Svg(QtCore.QRunnable):
 
     @QtCore.Slot()
     def run(self):
-        if not _core._which("dot"):
-            self.signals.error.emit(_DOT_ENVIRONMENT_ERROR)
-            return
-        error, svg_fp = _dot_2_svg(self.source_fp)
-        self.signals.error.emit(error) if error else self.signals.result.emit(svg_fp)
+        try:
+            if not (_agraph_cls() or _core._which("dot")):  # pygraphviz renders in-process, without a dot executable
+                self.signals.error.emit(_DOT_ENVIRONMENT_ERROR)
+                return
+            error, svg = self._convert(self.source_fp)
+            self.signals.error.emit(error) if error else self.signals.result.emit(svg)
+        finally:
+            self.signals.finished.emit()
+
+
+class _DotSource2Svg(_Dot2Svg):
+    """Converts the DOT text at source_fp, emitting the svg contents."""
+    _convert = staticmethod(_dot_source_2_svg)
 
 
 class _SvgPixmapViewport(_GraphicsViewport):
@@ -680,10 +897,15 @@ class _SvgPixmapViewport(_GraphicsViewport):
         self.setScene(scene)
 
     def load(self, filepath):
+        self._render(QtSvg.QSvgRenderer(filepath))
+
+    def setContent(self, data: QtCore.QByteArray, mimeType="", baseUrl=QtCore.QUrl()):
+        self._render(QtSvg.QSvgRenderer(data))
+
+    def _render(self, renderer):
         scene = self.scene()
         scene.clear()
 
-        renderer = QtSvg.QSvgRenderer(filepath)
         image = QtGui.QImage(renderer.defaultSize() * 1.5, QtGui.QImage.Format_ARGB32)
         image.fill(QtCore.Qt.transparent)
 
@@ -723,22 +945,53 @@ class _DotViewer(QtWidgets.QFrame):
         self._error_view.setVisible(False)
         self.setLayout(layout)
         self._dot2svg = None
-        self._threadpool = QtCore.QThreadPool()
+        self._pending_dot2svg = None  # (runner, result slot) latest request made while a runner was in progress
+        self._dot_source = None  # last requested DOT text, to avoid converting it again when re-requested
+        self._threadpool = _dot_threadpool()
+        # Files for this viewer live here and are removed with it (instead of leaking descriptors and files).
+        self._tempdir = tempfile.TemporaryDirectory(prefix="grill_dot_")
+        self._dot_path_ids = itertools.count()
         if not _USE_SVG_VIEWPORT:
             # otherwise it seems invisible
             self.setMinimumHeight(100)
 
+    def _newDotPath(self) -> str:
+        return str(Path(self._tempdir.name) / f"g_{next(self._dot_path_ids)}.dot")
+
     def setDotPath(self, path):
-        if self._dot2svg:  # forget about previous, unfinished runners
-            self._dot2svg.signals.error.disconnect()
-            self._dot2svg.signals.result.disconnect()
+        self._dot_source = None
+        self._start(_Dot2Svg(path), self._on_dot_result)
 
-        self._dot2svg = dot2svg = _Dot2Svg(path)
+    def setDotSource(self, source: str):
+        """Display the given DOT text without writing it to disk."""
+        if source == self._dot_source:  # already displayed (or about to be)
+            return
+        self._dot_source = source
+        self._start(_DotSource2Svg(source), self._on_svg_result)
+
+    def _start(self, dot2svg, on_result):
+        if self._dot2svg:
+            # Only one dot call at a time. Requests made in the meantime replace each other, so when the
+            # current runner finishes only the latest one is started (e.g. quickly going through many nodes).
+            self._pending_dot2svg = dot2svg, on_result
+            return
+
+        self._dot2svg = dot2svg
         dot2svg.signals.error.connect(self._on_dot_error)
-        dot2svg.signals.result.connect(self._on_dot_result)
+        dot2svg.signals.result.connect(on_result)
+        dot2svg.signals.finished.connect(self._on_dot_finished)
         self._threadpool.start(dot2svg)
 
+    def _on_dot_finished(self):
+        self._dot2svg = None
+        if self._pending_dot2svg:
+            pending, self._pending_dot2svg = self._pending_dot2svg, None
+            self._start(*pending)
+
     def _on_dot_error(self, message):
+        if self._dot_source is not None:  # failed sources are rendered again when re-requested, instead of skipped
+            self._dot_source = None
+            _dot_source_2_svg.cache_clear()
         self._error_view.setVisible(True)
         self._graph_view.setVisible(False)
         self._error_view.setText(message)
@@ -750,6 +1003,19 @@ class _DotViewer(QtWidgets.QFrame):
             filepath = QtCore.QUrl.fromLocalFile(filepath)
         self._graph_view.load(filepath)
 
+    def _on_svg_result(self, svg: str):
+        data = QtCore.QByteArray(svg.encode())
+        if not _USE_SVG_VIEWPORT and data.size() > _SET_CONTENT_LIMIT:
+            # too big to be set directly, go through a file instead.
+            svg_path = Path(f"{self._newDotPath()}.svg")
+            svg_path.write_bytes(data.data())
+            self._on_dot_result(str(svg_path))
+            return
+        self._error_view.setVisible(False)
+        self._graph_view.setVisible(True)
+        # base URL keeps relative node links (e.g. URL ids) resolvable
+        self._graph_view.setContent(data, "image/svg+xml", QtCore.QUrl.fromLocalFile(f"{self._tempdir.name}/"))
+
 
 class _GraphSVGViewer(_DotViewer):
     def __init__(self, *args, **kwargs):
@@ -759,6 +1025,7 @@ class _GraphSVGViewer(_DotViewer):
         self._graph = None
         self._viewing = frozenset()
         self._filter_edges = None
+        self._kept_edges_cache = (None, frozenset())
 
     @property
     def filter_edges(self):
@@ -768,7 +1035,7 @@ class _GraphSVGViewer(_DotViewer):
     def filter_edges(self, value):
         if value == self._filter_edges:
             return
-        self._subgraph_dot_path.cache_clear()
+        self._subgraph_dot_source.cache_clear()
         if value:
             predicate = lambda *edge: value(*edge) or bool({edge[0], edge[1]}.intersection(self.sticky_nodes))
         else:
@@ -783,42 +1050,30 @@ class _GraphSVGViewer(_DotViewer):
         node_uri = url.toString()
         node_uri_stem = node_uri.split("/")[-1]
         if node_uri_stem.startswith(self.url_id_prefix):
+            self._dot_source = None  # a link was followed so the view no longer displays our contents
             index = node_uri_stem.split(self.url_id_prefix)[-1]
             self.view([int(index)] if index.isdigit() else [index])
 
-    @cache
-    def _subgraph_dot_path(self, node_indices: tuple):
+    @lru_cache(maxsize=64)  # DOT sources of big graphs can be large, keep only the most recent ones
+    def _subgraph_dot_source(self, node_indices: frozenset):
         graph = self.graph
         if not graph:
             raise RuntimeError(f"'graph' attribute not set yet on {self}. Can't view nodes {node_indices}")
-        successors = chain.from_iterable(graph.successors(index) for index in node_indices)
-        predecessors = chain.from_iterable(graph.predecessors(index) for index in node_indices)
-        nodes_of_interest = chain(self.sticky_nodes, node_indices, successors, predecessors)
+        successors, predecessors = _adjacency(graph)
+        neighbours = chain.from_iterable(chain(successors[index], predecessors[index]) for index in node_indices)
+        nodes_of_interest = chain(self.sticky_nodes, node_indices, neighbours)
         subgraph = graph.subgraph(nodes_of_interest)
 
-        filters = {}
         if self.filter_edges:
-            print(f"{self.filter_edges=}")
-            filters['filter_edge'] = self.filter_edges
-        if filters:
-            subgraph = nx.subgraph_view(subgraph, **filters)
+            kept = _kept_edges(self)
+            subgraph = nx.subgraph_view(subgraph, filter_edge=lambda *edge: edge in kept)
 
-        fd, fp = tempfile.mkstemp()
-        try:
-            nx.nx_agraph.write_dot(subgraph, fp)
-        except ImportError as exc:
-            error = f"{exc}\n\n{_DOT_ENVIRONMENT_ERROR}"
-        else:
-            error = ""
-        return error, fp
+        return _dot_source(subgraph)
 
     def view(self, node_indices: typing.Iterable):
-        error, dot_path = self._subgraph_dot_path(tuple(node_indices))
-        self._viewing = frozenset(node_indices)
-        if error:
-            self._on_dot_error(error)
-        else:
-            self.setDotPath(dot_path)
+        self._viewing = viewing = frozenset(node_indices)
+        # order of indices does not change the subgraph, so (1, 2) and (2, 1) share a cached source
+        self.setDotSource(self._subgraph_dot_source(viewing))
 
     @property
     def graph(self):
@@ -826,7 +1081,7 @@ class _GraphSVGViewer(_DotViewer):
 
     @graph.setter
     def graph(self, graph):
-        self._subgraph_dot_path.cache_clear()
+        self._subgraph_dot_source.cache_clear()
         self.sticky_nodes.clear()
         self._graph = graph
 
@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import re
 import typing
+import hashlib
 import weakref
 import logging
 import operator
@@ -13,11 +14,11 @@ import collections
 from pathlib import Path
 from itertools import chain
 from collections import defaultdict
-from functools import cache, partial
+from functools import cache, lru_cache, partial
 from types import MappingProxyType
 
 import networkx as nx
-from pxr import UsdUtils, UsdShade, Usd, Ar, Pcp, Sdf, Tf
+from pxr import UsdShade, Usd, Ar, Pcp, Sdf, Tf
 from ._qt import QtWidgets, QtGui, QtCore
 
 from .. import usd as _usd
@@ -36,6 +37,12 @@ _ARCS_LEGEND = MappingProxyType({
     Pcp.ArcTypePayload: _color_attrs('#9370db'),  # ~purple
     Pcp.ArcTypeSpecialize: _color_attrs('sienna'),  # ~brown
 })
+# Legend of composition arcs on layer stack graphs: two invisible nodes connected by each arc type, same for every graph.
+_LEGEND_NODES = MappingProxyType({index: dict(style='invis') for index in range(len(_ARCS_LEGEND) * 2)})  # {int: dict}
+_LEGEND_EDGES = MappingProxyType({
+    (index * 2, index * 2 + 1): {None: {arc_type: dict(label=f" {arc_type.displayName}", **attributes)}}
+    for index, (arc_type, attributes) in enumerate(_ARCS_LEGEND.items())
+})
 _BROWSE_CONTENTS_MENU_TITLE = 'Browse Contents'
 _PALETTE = contextvars.ContextVar("_PALETTE", default=1)  # (0 == dark, 1 == light)
 _HIGHLIGHT_COLORS = MappingProxyType(
@@ -59,16 +66,36 @@ _HIGHLIGHT_COLORS = MappingProxyType(
         ("number", ("#bccad6", "#667292")),
     )}
 )
-_HIGHLIGHT_PATTERN = re.compile(
-    rf'(^(?P<comment>#.*$)|^( *(?P<specifier>def|over|class)( (?P<prim_type>\w+))? (?P<prim_name>\"\w+\")| +((?P<metadata>(?P<arc_selection>variants|payload|references)|{"|".join(_usd._metadata_keys())})|(?P<list_op>add|(ap|pre)pend|delete) (?P<arc>inherits|variantSets|references|payload|specializes|apiSchemas|rel (?P<rel_name>[\w:]+))|(?P<variantSet>variantSet) (?P<set_string>\"\w+\")|(?P<custom_meta>custom )?(?P<interpolation_meta>uniform )?(?P<prop_type>{"|".join(_usd._attr_value_type_names())}|dictionary|rel)(?P<prop_array>\[])? (?P<prop_name>[\w:.]+))( (\(|((?P<value_assignment>= )[\[(]?))|$))|(?P<string_value>\"[^\"]+\")|(?P<identifier>@[^@]+@)(?P<identifier_prim_path><[/\w]+>)?|(?P<relationship><[/\w:.]+>)|(?P<collapsed><< [^>]+ >>)|(?P<boolean>true|false)|(?P<number>-?[\d.]+))'
+# Longest first so that names sharing a prefix (e.g. float and float3) match without backtracking.
+# Sorting also keeps the same pattern between sessions, since these names come from sets.
+_METADATA_KEYS_PATTERN = "|".join(sorted(_usd._metadata_keys(), key=lambda key: (-len(key), key)))
+_ATTR_VALUE_TYPE_NAMES_PATTERN = "|".join(sorted(_usd._attr_value_type_names(), key=lambda name: (-len(name), name)))
+# Top level alternatives of the highlight pattern. A match comes from a single one, so only its groups are inspected.
+_HIGHLIGHT_BRANCHES = (
+    r'^(?P<comment>#.*$)',
+    rf'^(?: *(?P<specifier>def|over|class)(?: (?P<prim_type>\w+))? (?P<prim_name>\"\w+\")| +(?:(?P<metadata>(?P<arc_selection>variants|payload|references)|{_METADATA_KEYS_PATTERN})|(?P<list_op>add|(?:ap|pre)pend|delete) (?P<arc>inherits|variantSets|references|payload|specializes|apiSchemas|rel (?P<rel_name>[\w:]+))|(?P<variantSet>variantSet) (?P<set_string>\"\w+\")|(?P<custom_meta>custom )?(?P<interpolation_meta>uniform )?(?P<prop_type>{_ATTR_VALUE_TYPE_NAMES_PATTERN}|dictionary|rel)(?P<prop_array>\[])? (?P<prop_name>[\w:.]+))(?: (?:\(|(?P<value_assignment>= )[\[(]?)|$))',
+    r'(?P<string_value>\"[^\"]+\")',
+    r'(?P<identifier>@[^@]+@)(?P<identifier_prim_path><[/\w]+>)?',
+    r'(?P<relationship><[/\w:.]+>)',
+    r'(?P<collapsed><< [^>]+ >>)',
+    r'(?P<boolean>true|false)',
+    r'(?P<number>-?[\d.]+)',
 )
+_HIGHLIGHT_PATTERN = re.compile(f'(?:{"|".join(_HIGHLIGHT_BRANCHES)})')
+
+# Every alternative of the highlight pattern needs one of these characters. Blocks without any of them
+# (e.g. indented brackets and parentheses closing scopes, very common on layer contents) can't match.
+_HIGHLIGHT_CANDIDATE = re.compile(r'[\w"@<.#]')
+
+_IDENTIFIER_PATTERN = re.compile(r"@([^@]*)@")  # asset paths on layer contents
+_FILE_RELATIVE_PREFIXES = ("./", "../", ".\\", "..\\")  # identifiers anchored to the layer that authors them
 
 _OUTLINE_SDF_PATTERN = re.compile(  # this is a very minimal draft to have colors on the outline sdffilter mode.
-    rf'^((?P<identifier_prim_path>(  )?</[/\w+.:{{}}=]*(\[[/\w+.:{{}}=]+])?>)( : (?P<specifier>\w+))?|(  )?(?P<metadata>\w+)(: ((?P<number>-?[\d.]+)|(?P<string_value>[\w:.]+)(?P<prop_array>\[])?|(?P<collapsed><< [^>]+ >>)|(\[ (?P<relationship>[\w /.:{{}}=]+) ])|(?P<outline_details>.+)))?)$'  # sad, last item is a dot, lazy atm
+    rf'^(?:(?P<identifier_prim_path>(?:  )?</[/\w+.:{{}}=]*(?:\[[/\w+.:{{}}=]+])?>)(?: : (?P<specifier>\w+))?|(?:  )?(?P<metadata>\w+)(?:: (?:(?P<number>-?[\d.]+)|(?P<string_value>[\w:.]+)(?P<prop_array>\[])?|(?P<collapsed><< [^>]+ >>)|\[ (?P<relationship>[\w /.:{{}}=]+) ]|(?P<outline_details>.+)))?)$'  # sad, last item is a dot, lazy atm
 )
 
 _TREE_PATTERN = re.compile(  # draft as well output of usdtree
-    rf'^(?P<identifier_prim_path>([/`|\s:]+-+)(\w+)?)(\((?P<metadata>\w+)\)|(?P<prop_name>\.[\w:]+)|( \[(?P<specifier>def|over|class)( (?P<prim_type>\w+))?])( \((?P<custom_meta>[\w\s=]+)\))?)'
+    rf'^(?P<identifier_prim_path>[/`|\s:]+-+\w*)(?:\((?P<metadata>\w+)\)|(?P<prop_name>\.[\w:]+)|(?: \[(?P<specifier>def|over|class)(?: (?P<prim_type>\w+))?])(?: \((?P<custom_meta>[\w\s=]+)\))?)'
 )
 
 _USD_COMPOSITION_ARC_QUERY_METHODS = (
@@ -78,8 +105,12 @@ _USD_COMPOSITION_ARC_QUERY_METHODS = (
     Usd.CompositionArc.IsIntroducedInRootLayerPrimSpec,
     Usd.CompositionArc.IsIntroducedInRootLayerStack,
 )
-_USD_COMPOSITION_ARC_QUERY_KEYS = tuple(func.__name__ for func in _USD_COMPOSITION_ARC_QUERY_METHODS)
-_USD_COMPOSITION_ARC_QUERY_DEFAULTS = lambda: dict.fromkeys(_USD_COMPOSITION_ARC_QUERY_KEYS, False)
+# Query results are kept on layer stack graph edges as a single integer, one bit per query.
+_USD_COMPOSITION_ARC_QUERY_FLAGS = "query_flags"
+_USD_COMPOSITION_ARC_QUERY_BITS = MappingProxyType({func.__name__: 1 << index for index, func in enumerate(_USD_COMPOSITION_ARC_QUERY_METHODS)})
+_USD_COMPOSITION_ARC_QUERIES = tuple(zip(_USD_COMPOSITION_ARC_QUERY_BITS.values(), _USD_COMPOSITION_ARC_QUERY_METHODS))
+_LAYER_CONTENTS_CACHE = collections.OrderedDict()  # {(contents digest, identifier, *sdffilter args): (error, text)}
+_LAYER_CONTENTS_CACHE_SIZE = 64
 
 
 @cache
@@ -89,6 +120,26 @@ def _edge_color(edge_arcs):
 
 def _format_layer_contents(layer, output_type="pseudoLayer", paths=tuple(), output_args=tuple()):
     """Textual representation of a layer using ``sdffilter``."""
+    if output_type == "usdtree":  # usdtree opens a stage, so its output can depend on more than this layer's contents
+        return _export_and_format_layer_contents(layer, output_type, paths, output_args)
+    try:
+        # keyed on the in-memory contents, so dirty layers and files changed on disk are never served stale output
+        digest = hashlib.blake2b(layer.ExportToString().encode(), digest_size=16).digest()
+    except Tf.ErrorException:
+        return _export_and_format_layer_contents(layer, output_type, paths, output_args)
+    key = (digest, layer.identifier, output_type, tuple(paths), tuple(output_args))
+    if key in _LAYER_CONTENTS_CACHE:
+        _LAYER_CONTENTS_CACHE.move_to_end(key)
+        return _LAYER_CONTENTS_CACHE[key]
+    result = error, _ = _export_and_format_layer_contents(layer, output_type, paths, output_args)
+    if not error:
+        _LAYER_CONTENTS_CACHE[key] = result
+        if len(_LAYER_CONTENTS_CACHE) > _LAYER_CONTENTS_CACHE_SIZE:
+            _LAYER_CONTENTS_CACHE.popitem(last=False)
+    return result
+
+
+def _export_and_format_layer_contents(layer, output_type, paths, output_args):
     with tempfile.TemporaryDirectory() as target_dir:
         name = Path(layer.realPath).stem if layer.realPath else "".join(c if c.isalnum() else "_" for c in layer.identifier)
         path = Path(target_dir) / f"{name}.usd"
@@ -109,11 +160,21 @@ def _format_layer_contents(layer, output_type="pseudoLayer", paths=tuple(), outp
 
 
 def _layer_label(layer):
-    return layer.GetDisplayName() or layer.identifier
+    return _identifier_label(layer.identifier)
 
 
-@cache
-def _highlight_syntax_format(key, value):
+@lru_cache(maxsize=4096)
+def _identifier_label(identifier):
+    # keyed by identifier so layers themselves are not kept alive by the cache. Bounded, as sessions can open many layers
+    return Sdf.Layer.GetDisplayNameFromIdentifier(identifier) or identifier
+
+
+# Syntax groups with a format that depends on the matched text. Others are cached regardless of their value.
+_VALUE_DEPENDENT_SYNTAX = frozenset({"arc", "arc_selection", "specifier"})
+
+
+@lru_cache(maxsize=1024)
+def _highlight_syntax_format(key, value, palette):
     text_fmt = QtGui.QTextCharFormat()
     if key == "arc":
         key = "rel_op" if value.startswith("rel") else value
@@ -128,44 +189,49 @@ def _highlight_syntax_format(key, value):
             text_fmt.setFontLetterSpacing(135)
     elif key == "identifier":
         text_fmt.setFontUnderline(True)
-    text_fmt.setForeground(_HIGHLIGHT_COLORS[key][_PALETTE.get()])
+    text_fmt.setForeground(_HIGHLIGHT_COLORS[key][palette])
     return text_fmt
 
 
+@cache
+def _syntax_formats(palette) -> typing.Mapping[str, QtGui.QTextCharFormat]:
+    """Formats of the syntax groups that don't depend on the matched text, resolved once per palette."""
+    return MappingProxyType({
+        key: _highlight_syntax_format(key, None, palette) for key in _HIGHLIGHT_COLORS if key not in _VALUE_DEPENDENT_SYNTAX
+    })
+
+
 def _compute_layerstack_graph(prims, url_prefix) -> _GraphInfo:
     """Compute layer stack graph info for the provided prims"""
 
-    @cache
-    def _sublayers(layer_stack):  # {Sdf.Layer: int}
-        return MappingProxyType({v: i for i, v in enumerate(layer_stack.layers)})
-
     def _add_node(pcp_node):
         layer_stack = pcp_node.layerStack
         root_layer = layer_stack.identifier.rootLayer
-        sublayers = _sublayers(layer_stack)
         try:  # lru_cache not compatible with Pcp objects, so we "cache" at the layer level
-            return ids_by_root_layer[root_layer], sublayers
+            return ids_by_root_layer[root_layer]
         except KeyError:
             pass  # layerStack still not processed, let's add it
-        ids_by_root_layer[root_layer] = index = len(all_nodes)
+        index = len(all_nodes)
+        sublayers = {v: i for i, v in enumerate(layer_stack.layers)}  # {Sdf.Layer: int}
+        ids_by_root_layer[root_layer] = index, sublayers
 
         attrs = dict(style='rounded,filled', shape='record', href=f"{url_prefix}{index}", fillcolor="white", color="darkslategray")
-        plugs = []
-        label = '{'
-        tooltip = 'LayerStack:'
+        label_fields = []
+        tooltip_lines = ['LayerStack:']
         for layer, layer_index in sublayers.items():
-            indices_by_sublayers[layer].add(index)
+            indices_by_sublayers[layer].append(index)
             if layer.dirty:
                 attrs['color'] = 'darkorange'  # can probably be dashed as well?
-            # For new line: https://stackoverflow.com/questions/16671966/multiline-tooltip-for-pydot-graph
             # For Windows path sep: https://stackoverflow.com/questions/15094591/how-to-escape-forwardslash-character-in-html-but-have-it-passed-correctly-to-jav
-            tooltip += f"&#10;{layer_index}: {(layer.realPath or layer.identifier)}".replace('\\', '&#47;')
-            plugs.append(layer_index)
-            label += f"{'' if layer_index == 0 else '|'}<{layer_index}>{_layer_label(layer)}"
-        label += '}'
+            tooltip_lines.append(f"{layer_index}: {(layer.realPath or layer.identifier)}".replace('\\', '&#47;'))
+            label_fields.append(f"<{layer_index}>{_layer_label(layer)}")
         # attrs['plugs'] = dict(zip(plugs, range(len(plugs))))
-        attrs['plugs'] = tuple(plugs)
+        attrs['plugs'] = tuple(sublayers.values())
         attrs['active_plugs'] = set()  # all active connections, for GUI
+        # joined once instead of concatenated per sublayer (quadratic on big layer stacks)
+        label = '{' + '|'.join(label_fields) + '}'
+        # For new line: https://stackoverflow.com/questions/16671966/multiline-tooltip-for-pydot-graph
+        tooltip = '&#10;'.join(tooltip_lines)
         all_nodes[index] = dict(label=label, tooltip=tooltip, **attrs)
         return index, sublayers
 
@@ -173,9 +239,10 @@ def _compute_layerstack_graph(prims, url_prefix) -> _GraphInfo:
     def _compute_composition(_prim):
         query = Usd.PrimCompositionQuery(_prim)
         affected_by = set()  # {int}  indices of nodes affecting this prim
+        add_affected_by = affected_by.add
         for arc in query.GetCompositionArcs():
             target_idx, __ = _add_node(arc.GetTargetNode())
-            affected_by.add(target_idx)
+            add_affected_by(target_idx)
             source_layer = arc.GetIntroducingLayer()
             if source_layer:
                 # Note: arc.GetIntroducingNode() is not guaranteed to be the same as
@@ -183,35 +250,34 @@ def _compute_layerstack_graph(prims, url_prefix) -> _GraphInfo:
                 source_idx, source_layers = _add_node(arc.GetIntroducingNode())
                 source_port = source_layers[source_layer]
                 all_nodes[source_idx]['active_plugs'].add(source_port)  # all connections, for GUI
-                all_edges[source_idx, target_idx][source_port][arc.GetArcType()].update(
-                    {func.__name__:  is_fun for func in _USD_COMPOSITION_ARC_QUERY_METHODS if (is_fun := func(arc))}
-                )
+                arcs = all_edges.setdefault((source_idx, target_idx), {}).setdefault(source_port, {})
+                arc_type = arc.GetArcType()
+                flags = 0
+                for bit, func in _USD_COMPOSITION_ARC_QUERIES:
+                    if func(arc):
+                        flags |= bit
+                if arc_type in arcs:  # same arc found on other prims, keep the queries that are true for any of them
+                    arcs[arc_type][_USD_COMPOSITION_ARC_QUERY_FLAGS] |= flags
+                else:
+                    arcs[arc_type] = {_USD_COMPOSITION_ARC_QUERY_FLAGS: flags}
 
         return affected_by
 
-    all_nodes = dict()  # {int: dict}
-    all_edges = defaultdict(                            #   { (source_node: int, target_node: int):
-        lambda: defaultdict(                            #       { source_port: int:
-            lambda: defaultdict(                        #           { Pcp.ArcType:
-                _USD_COMPOSITION_ARC_QUERY_DEFAULTS     #               { HasArcs: bool, IsImplicit: bool, ... }
-            )                                           #           }
-        )                                               #       }
-    )                                                   #   }
-
-    for arc_type, attributes in _ARCS_LEGEND.items():
-        arc_label_node_ids = (len(all_nodes), len(all_nodes) + 1)
-        all_nodes.update(dict.fromkeys(arc_label_node_ids, dict(style='invis')))
-        all_edges[arc_label_node_ids][None][arc_type] = dict(label=f" {arc_type.displayName}", **attributes)
-
-    legend_node_ids = tuple(all_nodes)
-    ids_by_root_layer = dict()
-    indices_by_sublayers = defaultdict(set)  # {Sdf.Layer: {int,} }
+    all_nodes = dict(_LEGEND_NODES)  # {int: dict}  legend nodes are never modified, so they're not copied
+    all_edges = dict(_LEGEND_EDGES)  # {(source_node: int, target_node: int): {source_port: int: {Pcp.ArcType: {query_flags: int}}}}
+
+    legend_node_ids = tuple(_LEGEND_NODES)
+    ids_by_root_layer = dict()  # {Sdf.Layer: (int, {Sdf.Layer: int})}  node index and sublayer ports of each layer stack
+    # each layer stack node is added only once, so its index can't be repeated for a layer
+    indices_by_sublayers = defaultdict(list)  # {Sdf.Layer: [int,] }
     paths_by_node_idx = defaultdict(set)
 
     for prim in prims:
-        # use a forwarded prim in case of instanceability to avoid computing same stack more than once
+        # instance proxies share the composition of their prototype prim, so forward them to compute it only once.
+        # Same as UsdUtils.GetPrimAtPathWithForwarding but without a stage lookup for every prim.
+        forwarded = prim.GetPrimInPrototype() if prim.IsInstanceProxy() else prim
         prim_path = prim.GetPath()
-        for affected_by_idx in _compute_composition(UsdUtils.GetPrimAtPathWithForwarding(prim.GetStage(), prim_path)):
+        for affected_by_idx in _compute_composition(forwarded):
             paths_by_node_idx[affected_by_idx].add(prim_path)
 
     return _GraphInfo(
@@ -220,6 +286,7 @@ def _compute_layerstack_graph(prims, url_prefix) -> _GraphInfo:
         sticky_nodes=legend_node_ids,
         paths_by_ids=paths_by_node_idx,
         ids_by_layers=indices_by_sublayers,
+        all_paths=frozenset().union(*paths_by_node_idx.values()),
     )
 
 
@@ -252,10 +319,12 @@ def _graph_from_connections(prim: Usd.Prim) -> nx.MultiDiGraph:
     table_row = '<tr><td port="{port}" border="0" bgcolor="{color}" style="ROUNDED">{text}</td></tr>'
 
     traversed_prims = set()
-    def traverse(api: UsdShade.ConnectableAPI):
+    to_traverse = [connections_api]  # explicit stack instead of recursion, deep networks won't hit the recursion limit
+    while to_traverse:
+        api = to_traverse.pop()
         current_prim = api.GetPrim()
         if current_prim in traversed_prims:
-            return
+            continue
         traversed_prims.add(current_prim)
         node_id = _get_node_id(current_prim)
         label = f'<<table border="1" cellspacing="2" style="ROUNDED" bgcolor="{background_color}" color="{outline_color}">'
@@ -269,14 +338,12 @@ def _graph_from_connections(prim: Usd.Prim) -> nx.MultiDiGraph:
             label += table_row.format(port=plug_name, color=color, text=f'<font color="#242828">{plug_name}</font>')
             for source in sources:
                 _add_edges(_get_node_id(source.source.GetPrim()), source.sourceName, node_id, plug_name)
-                traverse(source.source)
+                to_traverse.append(source.source)
             plugs[plug_name] = index
             active_plugs.add(plug_name)  # TODO: add only actual plugged properties, right now we're adding all of them
         label += '</table>>'
         all_nodes[node_id] = dict(label=label, plugs=plugs, active_plugs=active_plugs)
 
-    traverse(connections_api)
-
     graph.add_nodes_from(all_nodes.items())
     graph.add_edges_from(edges)
     return graph
@@ -306,6 +373,7 @@ class _GraphInfo(typing.NamedTuple):
     edges: typing.Mapping
     nodes: typing.Mapping
     paths_by_ids: typing.Mapping
+    all_paths: frozenset  # union of paths_by_ids values
 
 
 @cache
@@ -321,7 +389,17 @@ def _nx_graph_edge_filter(*, has_specs=None, ancestral=None, implicit=None, intr
     }
     if not match:
         return None
-    return lambda edge_info: match.items() <= edge_info.items()
+    # a single lookup and bitwise comparison per edge (edge data are usually ChainMaps)
+    mask = sum(_USD_COMPOSITION_ARC_QUERY_BITS[key] for key in match)
+    expected = sum(_USD_COMPOSITION_ARC_QUERY_BITS[key] for key, value in match.items() if value)
+
+    def predicate(edge_info):
+        try:
+            return edge_info[_USD_COMPOSITION_ARC_QUERY_FLAGS] & mask == expected
+        except KeyError:  # e.g. legend edges have no arc query flags
+            return False
+
+    return predicate
 
 
 class _ConnectableAPIViewer(QtWidgets.QDialog):
@@ -350,6 +428,8 @@ class _ConnectableAPIViewer(QtWidgets.QDialog):
 class _Tree(_core._ColumnHeaderMixin, QtWidgets.QTreeView):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # rows display single lines of text only, so there's no need for Qt to query the height of each of them
+        self.setUniformRowHeights(True)
         self.expanded.connect(self._expand_all_children)
         self.collapsed.connect(self._collapse_all_children)
 
@@ -377,6 +457,136 @@ class _Tree(_core._ColumnHeaderMixin, QtWidgets.QTreeView):
         options.filterChanged.connect(self.expandAll)
 
 
+@cache
+def _composition_threadpool():
+    """Pool shared by composition widgets, separate from dot renders so slow composition queries don't hold them back.
+
+    A dedicated pool instead of QThreadPool.globalInstance, since that one might be in use by host applications.
+    """
+    pool = QtCore.QThreadPool()
+    pool.setMaxThreadCount(min(4, QtCore.QThread.idealThreadCount()))
+    return pool
+
+
+class _PrimIndexSignals(QtCore.QObject):
+    result = QtCore.Signal(object, object)  # (request, (index text, dot source, arc rows))
+    finished = QtCore.Signal()
+
+
+class _PrimIndexDump(QtCore.QRunnable):
+    """Dumps the prim index and composition arcs of a prim as plain data, to be displayed by the GUI thread."""
+    def __init__(self, prim, dot_path, columns, complete_target_layerstack, request, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.signals = _PrimIndexSignals()
+        self.prim = prim
+        self.dot_path = dot_path
+        self.columns = columns
+        self.complete_target_layerstack = complete_target_layerstack
+        self.request = request  # emitted with the result, so superseded requests can be told apart
+
+    @QtCore.Slot()
+    def run(self):
+        try:
+            self.signals.result.emit(self.request, self._dump())
+        finally:
+            self.signals.finished.emit()
+
+    def _dump(self):
+        prim_index = self.prim.GetPrimIndex()
+        index_text = prim_index.DumpToString()
+        # Pcp can only dump to files. Read it back so identical graphs re-use their cached svg (keyed by DOT contents).
+        dot_path = Path(self.dot_path)
+        prim_index.DumpToDotGraph(str(dot_path))
+        dot_source = dot_path.read_text()
+        dot_path.unlink()
+
+        rows = []  # [(parent key, key, values, edit target, target path, arc type name)]
+        for arc in Usd.PrimCompositionQuery(self.prim).GetCompositionArcs():
+            values = [str(getter(arc)) for getter in self.columns]
+            intro_node = arc.GetIntroducingNode()
+            target_node = arc.GetTargetNode()
+            target_path = target_node.path
+            target_layer = target_node.layerStack.identifier.rootLayer
+            arc_type_name = arc.GetArcType().displayName
+
+            # sites as (layer stack, path), hashable without formatting every layer identifier of the stack
+            parent_key = (intro_node.layerStack, intro_node.path)
+            sublayers = target_node.layerStack.layers if self.complete_target_layerstack else (target_layer,)
+            for each in sublayers:
+                if each == target_layer:  # we're the root layer of the target node's stack
+                    key, row_values = (target_node.layerStack, target_path), values
+                else:
+                    has_specs = bool(each.GetObjectAtPath(target_path))
+                    key, row_values = None, [_layer_label(each), values[1], values[2], values[3], str(has_specs)]
+                rows.append((parent_key, key, row_values, Usd.EditTarget(each, target_node), target_path, arc_type_name))
+
+        return index_text, dot_source, rows
+
+
+class _CompositionArcRow(typing.NamedTuple):
+    parent: typing.Optional[_CompositionArcRow]
+    row: int  # position on the parent's children
+    values: list  # display text for each column
+    data: tuple  # (Usd.Stage, Usd.EditTarget, Sdf.Path)  to browse and set edit targets from the context menu
+    foreground: typing.Optional[QtGui.QColor]
+    children: list
+
+
+class _CompositionArcsModel(QtCore.QAbstractItemModel):
+    """Read only tree of composition arcs, each arc a child of the arc that introduced it.
+
+    Rows are plain python objects referenced by the model indices, so populating a tree does not create a
+    QStandardItem per cell, nor notify views for every row.
+    """
+
+    def __init__(self, column_count: int, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._column_count = column_count
+        self._rows = []  # [_CompositionArcRow]  top level rows
+
+    def setRows(self, rows: list):
+        self.beginResetModel()
+        # indices point to rows without owning them, keep previous ones alive until views are done resetting
+        previous, self._rows = self._rows, rows
+        self.endResetModel()
+
+    def index(self, row:int, column:int, parent:QtCore.QModelIndex=QtCore.QModelIndex()) -> QtCore.QModelIndex:
+        siblings = parent.internalPointer().children if parent.isValid() else self._rows
+        if 0 <= row < len(siblings) and 0 <= column < self._column_count:
+            return self.createIndex(row, column, siblings[row])
+        return QtCore.QModelIndex()
+
+    def parent(self, index:QtCore.QModelIndex=QtCore.QModelIndex()) -> QtCore.QModelIndex:
+        if index.isValid() and (parent := index.internalPointer().parent) is not None:
+            return self.createIndex(parent.row, 0, parent)
+        return QtCore.QModelIndex()
+
+    def rowCount(self, parent:QtCore.QModelIndex=QtCore.QModelIndex()) -> int:
+        if parent.column() > 0:  # only the first column has children
+            return 0
+        return len(parent.internalPointer().children if parent.isValid() else self._rows)
+
+    def columnCount(self, parent:QtCore.QModelIndex=QtCore.QModelIndex()) -> int:
+        return self._column_count
+
+    def data(self, index:QtCore.QModelIndex, role:int=QtCore.Qt.DisplayRole) -> typing.Any:
+        arc_row = index.internalPointer()
+        if role == QtCore.Qt.DisplayRole:
+            try:
+                return arc_row.values[index.column()]
+            except IndexError:  # sublayers of a target layer stack only show some of the columns
+                return None
+        elif role == QtCore.Qt.UserRole:
+            return arc_row.data
+        elif role == QtCore.Qt.ForegroundRole:
+            return arc_row.foreground
+
+    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return ""  # column names are displayed by the header's own widgets
+        return super().headerData(section, orientation, role)
+
+
 class PrimComposition(QtWidgets.QDialog):
     # TODO: See if columns need to be updated from dict to tuple[_core.Column]
     _COLUMNS = {
@@ -401,7 +611,7 @@ class PrimComposition(QtWidgets.QDialog):
         super().__init__(*args, **kwargs)
         self.index_box = QtWidgets.QTextBrowser()
         self.index_box.setLineWrapMode(QtWidgets.QTextBrowser.NoWrap)
-        self._composition_model = model = QtGui.QStandardItemModel()
+        self._composition_model = model = _CompositionArcsModel(len(self._COLUMNS))
         columns = tuple(_core._Column(k, v) for k, v in self._COLUMNS.items())
         options = _core._ColumnOptions.SEARCH
         self.composition_tree = tree = _Tree(model, columns, options)
@@ -411,6 +621,8 @@ class PrimComposition(QtWidgets.QDialog):
         tree.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
 
         self._dot_view = _graph._DotViewer(parent=self)
+        self._threadpool = _composition_threadpool()
+        self._prim_index_request = None  # latest prim index requested, results from previous ones are ignored
 
         tree_controls = QtWidgets.QFrame()
         tree_controls_layout = QtWidgets.QHBoxLayout()
@@ -439,7 +651,7 @@ class PrimComposition(QtWidgets.QDialog):
         self.setWindowTitle("Prim Composition")
 
     def clear(self):
-        self._composition_model.clear()
+        self._composition_model.setRows([])
         self.index_box.clear()
 
     def _exec_context_menu(self):
@@ -454,79 +666,59 @@ class PrimComposition(QtWidgets.QDialog):
 
     def setPrim(self, prim):
         self._prim = prim
+        self._prim_index_request = None
         if not self._prim:
             self.clear()
             self.setWindowTitle("Prim Composition")
             return
         self.setWindowTitle(f"Prim Composition: {prim.GetName()} ({prim.GetPath()})")
-        prim_index = prim.GetPrimIndex()
-        self.index_box.setText(prim_index.DumpToString())
-        fd, fp = tempfile.mkstemp()
-        prim_index.DumpToDotGraph(fp)
-        self._dot_view.setDotPath(fp)
-
+        columns = tuple(self._COLUMNS.values())
         complete_target_layerstack = self._complete_target_layerstack.isChecked()
-        # model.clear() resizes the columns. So we keep track of current sizes.
-        header = self.composition_tree.header()
-        sizes = {index: size for index in header.options_by_index if (size:=header.sectionSize(index))}
-
-        tree = self.composition_tree
-        model = self._composition_model
-        model.clear()
-        model.setHorizontalHeaderLabels([""] * len(self._COLUMNS))
-        root_item = model.invisibleRootItem()
-
-        query = Usd.PrimCompositionQuery(prim)
-        items = dict()
-        stage = prim.GetStage()
-        arcs = query.GetCompositionArcs()
-        for arc in arcs:
-            values = [getter(arc) for getter in self._COLUMNS.values()]
-
-            intro_node = arc.GetIntroducingNode()
-            target_node = arc.GetTargetNode()
-            target_path = target_node.path
-            target_layer = target_node.layerStack.identifier.rootLayer
-
-            # TODO: is there a better way than relying on str(node.site)???
-            key = str(intro_node.site)
-            parent = items[key] if key in items else root_item
-
+        self._prim_index_request = request = object()
+        dump = _PrimIndexDump(prim, self._dot_view._newDotPath(), columns, complete_target_layerstack, request)
+        dump.signals.result.connect(self._on_prim_index_dumped)
+        # the prim's stage is read by the runner, so user input (which could edit it) is held meanwhile
+        _core._run_holding_user_input(self._threadpool, dump, dump.signals.finished)
+
+    def _on_prim_index_dumped(self, request, result):
+        if request is not self._prim_index_request:  # superseded by a later request, already queued when it was made
+            return
+        index_text, dot_source, rows = result
+        self._prim_index_request = None
+        self.index_box.setText(index_text)
+        self._dot_view.setDotSource(dot_source)
+
+        stage = self._prim.GetStage()
+        palette = _PALETTE.get()
+        arcs = dict()
+        top_rows = []
+        for parent_key, key, values, edit_target, target_path, arc_type_name in rows:
+            parent = arcs.get(parent_key)  # before registering this row, the root arc introduces itself
             try:
-                highlight_color = _HIGHLIGHT_COLORS[arc.GetArcType().displayName][_PALETTE.get()]
+                highlight_color = _HIGHLIGHT_COLORS[arc_type_name][palette]
             except KeyError:
                 highlight_color = None
+            siblings = top_rows if parent is None else parent.children
+            arc_row = _CompositionArcRow(parent, len(siblings), values, (stage, edit_target, target_path), highlight_color, [])
+            siblings.append(arc_row)
+            if key:
+                arcs[key] = arc_row
 
-            sublayers = target_node.layerStack.layers if complete_target_layerstack else (target_layer,)
-            for each in sublayers:
-                if each == target_layer:  # we're the root layer of the target node's stack
-                    arc_items = [QtGui.QStandardItem(str(s)) for s in values]
-                    items[str(target_node.site)] = arc_items[0]
-                else:
-                    has_specs = bool(each.GetObjectAtPath(target_path))
-                    arc_items = [QtGui.QStandardItem(str(s)) for s in [_layer_label(each), values[1], values[2], values[3], str(has_specs)]]
-
-                edit_target = Usd.EditTarget(each, target_node)
-                for item in arc_items:
-                    item.setData((stage, edit_target, target_path), QtCore.Qt.UserRole)
-                    if highlight_color:
-                        item.setData(highlight_color, QtCore.Qt.ForegroundRole)
-
-                parent.appendRow(arc_items)
-
+        self._composition_model.setRows(top_rows)
+        tree = self.composition_tree
         tree.expandAll()
         tree._fixPositions()  # TODO: Houdini needs this. Why?
-        for index, size in sizes.items():
-            header.resizeSection(index, size)
 
 
 class LayerTableModel(_core._ObjectTableModel):
+    # TODO: add a concrete color value for "dirty" layers?
+    _DIRTY_COLOR = _sheets._PrimTextColor.ARCS.value
+    _CLEAN_COLOR = _sheets._PrimTextColor.NONE.value
+
     def data(self, index:QtCore.QModelIndex, role:int=...) -> typing.Any:
         if role == QtCore.Qt.ForegroundRole:
-            layer = self.data(index, role=_core._QT_OBJECT_DATA_ROLE)
-            # TODO: add a concrete color value for "dirty" layers?
-            color = _sheets._PrimTextColor.ARCS if layer.dirty else _sheets._PrimTextColor.NONE
-            return color.value
+            # queried for every visible cell on each paint: skip the enum and the raw data role dispatch
+            return self._DIRTY_COLOR if self._objects[index.row()].dirty else self._CLEAN_COLOR
         return super().data(index, role)
 
     def setLayers(self, value):
@@ -535,24 +727,109 @@ class LayerTableModel(_core._ObjectTableModel):
         self.endResetModel()
 
 
+@cache
+def _syntax_groups(pattern: re.Pattern, branches: tuple = ()) -> typing.Mapping[int, tuple]:
+    """Named groups of pattern in definition order as (index, name, whether its format depends on the matched text).
+
+    Groups are mapped by the index of any of them, as reported by a match's lastindex. When the pattern is made of
+    the given top level branches, only the groups of the branch that an index belongs to are included.
+    """
+    groups = tuple(
+        (index, name, name in _VALUE_DEPENDENT_SYNTAX)
+        for name, index in sorted(pattern.groupindex.items(), key=lambda item: item[1])
+    )
+    names_by_branch = [re.compile(branch).groupindex.keys() for branch in branches] or [pattern.groupindex.keys()]
+    groups_by_index = {}
+    for names in names_by_branch:
+        branch_groups = tuple(group for group in groups if group[1] in names)
+        groups_by_index.update(dict.fromkeys((index for index, *__ in branch_groups), branch_groups))
+    return MappingProxyType(groups_by_index)
+
+
 class _Highlighter(QtGui.QSyntaxHighlighter):
     _pattern = _HIGHLIGHT_PATTERN
+    _branches = _HIGHLIGHT_BRANCHES  # top level alternatives of the pattern, if any
+    _anchored = False  # patterns starting with ^ can only match at the start of a block
+    # Patterns don't span multiple lines, so on text editors with big contents only blocks
+    # around the visible area are highlighted, the rest are highlighted when scrolled into view.
+    _LAZY_BLOCK_COUNT = 5_000
+    _LAZY_OVERSCAN = 100  # blocks highlighted beyond the visible area
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self._editor = parent if isinstance(parent, QtWidgets.QTextEdit) else None
+        self._pending_blocks = set()  # numbers of blocks skipped while not visible
+        self._visible_blocks = None  # range of block numbers to highlight, reset when scrolling or resizing
+        if self._editor:
+            scrollbar = self._editor.verticalScrollBar()
+            scrollbar.valueChanged.connect(self._highlight_visible_blocks)
+            scrollbar.rangeChanged.connect(self._highlight_visible_blocks)
+
+    def _visible_block_range(self):
+        if self._visible_blocks is None:
+            # With no wrapping and a fixed font, each block is a single line of the same height.
+            editor = self._editor
+            line_spacing = max(editor.fontMetrics().lineSpacing(), 1)
+            first = editor.verticalScrollBar().value() // line_spacing
+            last = first + editor.viewport().height() // line_spacing
+            self._visible_blocks = range(max(first - self._LAZY_OVERSCAN, 0), last + self._LAZY_OVERSCAN + 1)
+        return self._visible_blocks
+
+    def _highlight_visible_blocks(self, *_):
+        self._visible_blocks = None
+        if not self._pending_blocks:
+            return
+        document = self.document()
+        for number in self._visible_block_range():
+            if number in self._pending_blocks:
+                self._pending_blocks.discard(number)
+                if (block := document.findBlockByNumber(number)).isValid():
+                    self.rehighlightBlock(block)
 
     def highlightBlock(self, text):
-        for match in re.finditer(self._pattern, text):
-            for syntax_group, value in match.groupdict().items():
-                if not value:
+        if not text:  # empty lines are common on layer contents, skip them before the pattern runs
+            return
+        if self._editor and self.document().blockCount() > self._LAZY_BLOCK_COUNT:
+            number = self.currentBlock().blockNumber()
+            if number not in self._visible_block_range():
+                self._pending_blocks.add(number)
+                return
+            self._pending_blocks.discard(number)
+        palette = _PALETTE.get()
+        formats = _syntax_formats(palette)
+        if self._anchored:
+            matches = filter(None, (self._pattern.match(text),))
+        elif text.startswith("#"):  # a comment spans the whole block, no need to run the pattern for it
+            self.setFormat(0, len(text), formats["comment"])
+            return
+        elif not _HIGHLIGHT_CANDIDATE.search(text):
+            return
+        else:
+            matches = self._pattern.finditer(text)
+        groups_by_index = _syntax_groups(self._pattern, self._branches)
+        for match in matches:
+            span = match.span
+            for index, syntax_group, value_dependent in groups_by_index.get(match.lastindex, ()):
+                start, end = span(index)
+                if start >= end:  # (-1, -1) when the group did not participate in the match
                     continue
-                start, end = match.span(syntax_group)
-                self.setFormat(start, end-start, _highlight_syntax_format(syntax_group, value))
+                if value_dependent:
+                    text_fmt = _highlight_syntax_format(syntax_group, text[start:end], palette)
+                else:
+                    text_fmt = formats[syntax_group]
+                self.setFormat(start, end-start, text_fmt)
 
 
 class _SdfOutlineHighlighter(_Highlighter):
     _pattern = _OUTLINE_SDF_PATTERN
+    _anchored = True
+    _branches = ()
 
 
 class _TreeOutlineHighlighter(_Highlighter):
     _pattern = _TREE_PATTERN
+    _anchored = True
+    _branches = ()
 
 
 class _LayersSheet(_sheets._Spreadsheet):
@@ -582,19 +859,19 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
     def __init__(self, layer, *args, resolver_context=Ar.GetResolver().CreateDefaultContext(), paths=tuple(), **kwargs):
         super().__init__(*args, **kwargs)
         self._resolver_context = resolver_context
-        self._browsers_by_layer = dict()  # {Sdf.Layer: _PseudoUSDTabBrowser}
-        self._tab_layer_by_idx = list()  # [tab_idx: Sdf.Layer]
+        self._browsers_by_layer = dict()  # {weakref.ref[Sdf.Layer] | str: QtWidgets.QFrame}, tab widgets know their key
         self._addLayerTab(layer, paths)
         self._resolved_layers = {layer}
         self.setTabsClosable(True)
-        self.tabCloseRequested.connect(lambda idx: self.removeTab(idx))
+        self.tabCloseRequested.connect(self._close_tab)
 
-    def tabRemoved(self, index: int) -> None:
-        item = self._tab_layer_by_idx[index]
-        if isinstance(item, (Sdf.Layer, weakref.ref)):
-            item = item.__repr__.__self__
-            self._resolved_layers.discard(item)
-        del self._browsers_by_layer[self._tab_layer_by_idx.pop(index)]
+    def _close_tab(self, index: int) -> None:
+        widget = self.widget(index)
+        self.removeTab(index)
+        key = widget._browser_key
+        del self._browsers_by_layer[key]
+        if isinstance(key, weakref.ref):
+            self._resolved_layers.discard(key())
 
     def mousePressEvent(self, event):
         if event.button() == QtCore.Qt.RightButton and (tab_index := self.tabBar().tabAt(event.pos())) != -1:
@@ -609,8 +886,8 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
         menu.addAction("Copy Identifier", partial(clipboard.setText, widget._identifier))
         menu.addAction("Copy Resolved Path", partial(clipboard.setText, widget._resolved_path))
         menu.addSeparator()
-        if tab_index < (max_tab_idx := len(self._tab_layer_by_idx)) - 1:
-            menu.addAction("Close Tabs to the Right", partial(self._close_many, range(tab_index + 1, max_tab_idx + 1)))
+        if tab_index < (max_tab_idx := self.count()) - 1:
+            menu.addAction("Close Tabs to the Right", partial(self._close_many, range(tab_index + 1, max_tab_idx)))
         if tab_index > 0:
             menu.addAction("Close Tabs to the Left", partial(self._close_many, range(tab_index)))
         return menu
@@ -652,8 +929,7 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
             focus_widget._identifier = identifier
             self.setTabToolTip(tab_idx, path)
 
-            self._tab_layer_by_idx.append(path)
-            assert len(self._tab_layer_by_idx) == (tab_idx + 1)
+            focus_widget._browser_key = path
             self._browsers_by_layer[path] = focus_widget
 
         self.setCurrentWidget(focus_widget)
@@ -679,25 +955,15 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
 
             outliner_columns = (_core._Column("Path", lambda path: path.name),)
             outline_model = QtGui.QStandardItemModel()
-            outline_tree = _Tree(outline_model, outliner_columns, _core._ColumnOptions.SEARCH)
-            outline_tree.setSelectionMode(outline_tree.SelectionMode.ExtendedSelection)
-            outline_tree.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
-
-            def show_outline_tree_context_menu(*args):
-                if selected_indexes:= outline_tree.selectedIndexes():
-                    content = "\n".join(str(index.data(QtCore.Qt.UserRole)) for index in selected_indexes if index.isValid())
-                    menu = QtWidgets.QMenu(outline_tree)
-                    menu.addAction("Copy Paths", partial(QtWidgets.QApplication.instance().clipboard().setText, content))
-                    menu.exec_(QtGui.QCursor.pos())
-
-            outline_tree.customContextMenuRequested.connect(show_outline_tree_context_menu)
-
             outline_model.setHorizontalHeaderLabels([""] * len(outliner_columns))
             root_item = outline_model.invisibleRootItem()
 
             items = dict()  # {Sdf.Path: QtGui.QItem}
 
             def populate(spec_paths, *_, **__):
+                # rows are appended under items that are not in the model yet, which is notified once per top row
+                top_rows = []
+                variant_color = _HIGHLIGHT_COLORS["variantSets"][_PALETTE.get()]
                 for path in spec_paths:
                     if path.IsPropertyPath() or path.IsTargetPath():
                         continue
@@ -705,27 +971,48 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
                     variant_set, selection = path.GetVariantSelection()
                     if path.IsPrimVariantSelectionPath() and selection:  # place all variant selections under the variant set
                         parent_key = parent_key.AppendVariantSelection(variant_set, "")
-                    highlight_color = _HIGHLIGHT_COLORS["variantSets"][_PALETTE.get()] if variant_set else None
-                    parent = items[parent_key] if parent_key in items else root_item
+                    highlight_color = variant_color if variant_set else None
                     new_items = [QtGui.QStandardItem(str(column.getter(path))) for column in outliner_columns]
                     if highlight_color:
                         for item in new_items:
                             item.setData(highlight_color, QtCore.Qt.ForegroundRole)
-                    parent.appendRow(new_items)
                     new_items[0].setData(path, QtCore.Qt.UserRole)
+                    if parent_key in items:
+                        items[parent_key].appendRow(new_items)
+                    else:
+                        top_rows.append(new_items)
                     items[path] = new_items[0]
+                for new_items in top_rows:
+                    root_item.appendRow(new_items)
 
             content_paths = list()
-            layer.Traverse(layer.pseudoRoot.path, lambda path: content_paths.append(path))
+            layer.Traverse(layer.pseudoRoot.path, content_paths.append)
+            # populate before any view (and its filter proxy models) is attached, so they don't process every inserted row
+            populate(sorted(content_paths))  # Sdf.Layer.Traverse collects paths from deepest -> highest. Sort from high -> deep
+
+            outline_tree = _Tree(outline_model, outliner_columns, _core._ColumnOptions.SEARCH)
+            outline_tree.setSelectionMode(outline_tree.SelectionMode.ExtendedSelection)
+            outline_tree.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+
+            def show_outline_tree_context_menu(*args):
+                if selected_indexes:= outline_tree.selectedIndexes():
+                    content = "\n".join(str(index.data(QtCore.Qt.UserRole)) for index in selected_indexes if index.isValid())
+                    menu = QtWidgets.QMenu(outline_tree)
+                    menu.addAction("Copy Paths", partial(QtWidgets.QApplication.instance().clipboard().setText, content))
+                    menu.exec_(QtGui.QCursor.pos())
+
+            outline_tree.customContextMenuRequested.connect(show_outline_tree_context_menu)
+
             selection_model = outline_tree.selectionModel()
-            highligther_cls = _Highlighter
             highlighters = {"pseudoLayer": _Highlighter, "outline": _SdfOutlineHighlighter, "usdtree": _TreeOutlineHighlighter}
             def _ensure_highligther(cls):
-                nonlocal highligther_cls
-                if highligther_cls != cls:
+                nonlocal highlighter
+                if type(highlighter) is not cls:
                     browser.setText("")  # clear contents before changing highlighting to avoid locks with huge contents
-                    highligther_cls = cls
-                    highligther_cls(browser)
+                    # a document runs every highlighter attached to it, so detach the previous one
+                    highlighter.setDocument(None)
+                    highlighter.deleteLater()
+                    highlighter = cls(browser)
                 sorting_combo.setEnabled(cls == _SdfOutlineHighlighter)
                 outline_valies_check.setEnabled(cls == _SdfOutlineHighlighter)
 
@@ -757,15 +1044,17 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
                     line_counter.setFixedWidth(12 + (len(str(line_count)) * 8))
                     browser.setText(error if error else text)
 
-            populate(sorted(content_paths))  # Sdf.Layer.Traverse collects paths from deepest -> highest. Sort from high -> deep
-
             if paths_in_layer:
                 tree_model = outline_tree.model()
+                # a single selection for all paths, instead of updating the selection model once per path
+                selection = QtCore.QItemSelection()
+                for path in paths_in_layer:
+                    proxy_index = tree_model.mapFromSource(outline_model.indexFromItem(items[path]))
+                    selection.select(proxy_index, proxy_index)
                 with QtCore.QSignalBlocker(outline_tree):
-                    for path in paths_in_layer:
-                        proxy_index = tree_model.mapFromSource(outline_model.indexFromItem(items[path]))
-                        selection_model.select(proxy_index, QtCore.QItemSelectionModel.Select | QtCore.QItemSelectionModel.Rows)
-                        outline_tree.setCurrentIndex(proxy_index)  # possible to set multiple?
+                    selection_model.select(selection, QtCore.QItemSelectionModel.Select | QtCore.QItemSelectionModel.Rows)
+                    # NoUpdate, otherwise the view replaces the selection with the current index
+                    selection_model.setCurrentIndex(proxy_index, QtCore.QItemSelectionModel.NoUpdate)
             else:
                 outline_tree.expandRecursively(root_item.index(), 3)
 
@@ -825,7 +1114,7 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
 
             browser = _PseudoUSDTabBrowser(parent=self)
             browser.setLineWrapMode(QtWidgets.QTextBrowser.NoWrap)
-            _Highlighter(browser)
+            highlighter = _Highlighter(browser)
             browser.identifier_requested.connect(partial(self._on_identifier_requested, weakref.proxy(layer)))
             browser.setText(text)
 
@@ -869,8 +1158,7 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
             focus_widget._identifier = identifier or layer.identifier
             self.setTabToolTip(tab_idx, str(layer.resolvedPath))
 
-            self._tab_layer_by_idx.append(layer_ref)
-            assert len(self._tab_layer_by_idx) == (tab_idx+1)
+            focus_widget._browser_key = layer_ref
             self._browsers_by_layer[layer_ref] = focus_widget
         self.setCurrentWidget(focus_widget)
 
@@ -878,7 +1166,8 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
         anchor = anchor.__repr__.__self__
         with Ar.ResolverContextBinder(self._resolver_context):
             try:
-                if not (layer := Sdf.Layer.FindOrOpen(identifier)):
+                # file relative identifiers are always anchored, so don't look them up on the current directory first
+                if identifier.startswith(_FILE_RELATIVE_PREFIXES) or not (layer := Sdf.Layer.FindOrOpen(identifier)):
                     layer = Sdf.Layer.FindOrOpenRelativeToLayer(anchor, identifier)
             except Tf.ErrorException as exc:
                 resolved_path = str(Ar.GetResolver().Resolve(identifier)) or anchor.ComputeAbsolutePath(identifier)
@@ -896,6 +1185,7 @@ class _PseudoUSDBrowser(QtWidgets.QTabWidget):
                 text = f"Could not find layer with {identifier=} under resolver context {self._resolver_context} with {anchor=}"
             QtWidgets.QMessageBox.warning(self, title, text)
 
+
 @cache
 def _image_formats_to_browse():
     return frozenset(str(fmt, 'utf-8') for fmt in QtGui.QImageReader.supportedImageFormats())
@@ -913,17 +1203,13 @@ class _PseudoUSDTabBrowser(QtWidgets.QTextBrowser):
 
     def mousePressEvent(self, event):
         cursor = self.cursorForPosition(event.pos())
-        cursor.select(QtGui.QTextCursor.WordUnderCursor)
-        word = cursor.selectedText()
-        cursor.movePosition(QtGui.QTextCursor.StartOfLine, QtGui.QTextCursor.KeepAnchor)
-        # Take advantage that identifiers in pseudo sdffilter come always in separate lines
-        if f"{cursor.selectedText()}{word}".count('@') == 1 and (
-                match := re.search(
-                    rf"@(?P<identifier>[^@]*({re.escape(word.strip('@'))})[^@]*)@",
-                    cursor.block().text()
-                )
+        column = cursor.positionInBlock()
+        # identifiers don't span multiple lines, so only the clicked block is searched for the one under the cursor
+        if identifier := next(
+                (match.group(1) for match in _IDENTIFIER_PATTERN.finditer(cursor.block().text()) if match.start() < column < match.end()),
+                None
         ):
-            self._target = match.group("identifier")
+            self._target = identifier
             QtWidgets.QApplication.setOverrideCursor(QtGui.Qt.PointingHandCursor)
         else:
             self._target = None
@@ -947,6 +1233,35 @@ class _PseudoUSDTabBrowser(QtWidgets.QTextBrowser):
             super().wheelEvent(event)
 
 
+class _LayerStackGraphSignals(QtCore.QObject):
+    result = QtCore.Signal(object, object)  # (request, _GraphInfo)
+    finished = QtCore.Signal()
+
+
+class _LayerStackGraphCompute(QtCore.QRunnable):
+    """Computes the layer stack graph of a stage's prims, to be displayed by the GUI thread."""
+    def __init__(self, stage, prim_paths, url_prefix, request, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.signals = _LayerStackGraphSignals()
+        self.stage = stage
+        self.prim_paths = prim_paths
+        self.url_prefix = url_prefix
+        self.request = request  # emitted with the result, so superseded requests can be told apart
+
+    @QtCore.Slot()
+    def run(self):
+        try:
+            if self.prim_paths:  # look requested prims up, instead of traversing the whole stage to find them
+                prims = filter(None, map(self.stage.GetPrimAtPath, sorted(self.prim_paths)))
+            else:
+                predicate = Usd.TraverseInstanceProxies(Usd.PrimAllPrimsPredicate)
+                prims = Usd.PrimRange.Stage(self.stage, predicate)
+                # prims = (prim for prim in prims if prim.IsActive())
+            self.signals.result.emit(self.request, _compute_layerstack_graph(prims, self.url_prefix))
+        finally:
+            self.signals.finished.emit()
+
+
 class LayerStackComposition(QtWidgets.QDialog):
     # TODO: display total amount of layer stacks, and sites
     #       TOO SLOW!! (ALab workbench environment takes 7 seconds for the complete stage.)
@@ -1029,9 +1344,22 @@ class LayerStackComposition(QtWidgets.QDialog):
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(vertical)
         self.setLayout(layout)
+        # Rubber band and shift selections emit selectionChanged for every intermediate step,
+        # so updates are coalesced and only the final selection is computed.
+        self._selection_timer = selection_timer = QtCore.QTimer(self)
+        selection_timer.setSingleShot(True)
+        selection_timer.setInterval(100)
+        selection_timer.timeout.connect(self._update_selection)
         selectionModel = self._layers.table.selectionModel()
         selectionModel.selectionChanged.connect(self._selectionChanged)
         self._prim_paths_to_compute = set()
+        self._graph_info_key = None  # (stage, prim paths) the current graph info was computed for, reset on stage changes
+        self._stage_listener = None
+        self._dirtiness_listener = None
+        self._threadpool = _composition_threadpool()
+        self._graph_info_request = None  # latest graph info requested, results from previous ones are ignored
+        self._computed_graph_info = None
+        self._graph_info_pending_key = None  # key for the runner's result, reset if the stage changes meanwhile
         self.setWindowTitle("LayerStack Composition")
 
     def _edge_filter_changed(self, *args, **kwargs):
@@ -1044,32 +1372,29 @@ class LayerStackComposition(QtWidgets.QDialog):
             introduced_in_root_layer_stack=state(self._from_root_layer_stack),
         )
         graph = self._graph_view.graph
-        # self._graph_view.filter_edges = (lambda *edge: edge_data_filter(graph.edges[edge])) if edge_data_filter else None
-        from pprint import pp
-        def actual(*edge):
-            # edge_info = graph.edges[edge]
-            # pp(edge_info)
-            # print(f"{edge_data_filter=}")
-            result = edge_data_filter(graph.edges[edge])
-            # print(f"{result=}")
-            return result
-
-        self._graph_view.filter_edges = actual if edge_data_filter else None
+        self._graph_view.filter_edges = (lambda *edge: edge_data_filter(graph.edges[edge])) if edge_data_filter else None
         if isinstance(self._graph_view, _graph._GraphSVGViewer):
-            self._graph_view._subgraph_dot_path.cache_clear()
+            self._graph_view._subgraph_dot_source.cache_clear()
         self._graph_view.view(self._graph_view._viewing)
 
     def _selectionChanged(self, selected: QtCore.QItemSelection, deselected: QtCore.QItemSelection):
+        self._selection_timer.start()
+
+    def _update_selection(self):
         node_ids = {index.data(_core._QT_OBJECT_DATA_ROLE) for index in self._layers.table.selectedIndexes()}
-        node_indices = set(chain.from_iterable(self._computed_graph_info.ids_by_layers[layer] for layer in node_ids))
+        graph_info = self._computed_graph_info
+        if not graph_info:  # being computed, the selection is updated once the result arrives
+            return
+        node_indices = set().union(*(graph_info.ids_by_layers[layer] for layer in node_ids))
 
         prims_model = self._prims.model
-        prims_model._root_paths = paths = set(chain.from_iterable(
+        paths_by_ids = graph_info.paths_by_ids
+        prims_model._root_paths = paths = set().union(
             # some layers from the layer stack might be on our selected indices but they wont be on the paths_by_ids
-            self._computed_graph_info.paths_by_ids[i] for i in node_indices if i in self._computed_graph_info.paths_by_ids)
+            *(paths_by_ids[i] for i in node_indices if i in paths_by_ids)
         )
-        all_paths = set(chain.from_iterable(self._computed_graph_info.paths_by_ids.values()))
-        self._prims._filter_predicate = lambda prim: prim.GetPath() in (paths or all_paths)
+        visible_paths = paths or graph_info.all_paths  # resolved once instead of for every traversed prim
+        self._prims._filter_predicate = lambda prim: prim.GetPath() in visible_paths
         self._prims._update_stage()
         self._graph_view.view(node_indices)
 
@@ -1078,22 +1403,50 @@ class LayerStackComposition(QtWidgets.QDialog):
         """Sets the USD stage the spreadsheet is looking at."""
         self._stage = stage
         self._layers._resolver_context = stage.GetPathResolverContext()
-        predicate = Usd.TraverseInstanceProxies(Usd.PrimAllPrimsPredicate)
-        prims = Usd.PrimRange.Stage(stage, predicate)
-        # prims = (prim for prim in prims if prim.IsActive())
-        if self._prim_paths_to_compute:
-            prims = (p for p in prims if p.GetPath() in self._prim_paths_to_compute)
-            self._prims._filter_predicate = lambda prim: prim.GetPath() in self._prim_paths_to_compute
-
-        graph_info = _compute_layerstack_graph(prims, self._graph_view.url_id_prefix)
+        prim_paths = frozenset(self._prim_paths_to_compute)
+        if prim_paths:
+            self._prims._filter_predicate = lambda prim: prim.GetPath() in prim_paths
+
         self._prims.setStage(stage)
-        # self._edge_filter_changed()
+        graph_info_key = (stage, prim_paths)
+        if graph_info_key == self._graph_info_key:  # nothing changed since our last computation, so re-use it
+            # self._edge_filter_changed()
+            self._update_graph_from_graph_info(self._computed_graph_info)
+            return
+
+        # Traversing and querying composition of big stages takes seconds, keep the GUI painting meanwhile.
+        self._graph_info_key = self._computed_graph_info = None  # the previous stage's graph no longer applies
+        self._stage_listener = Tf.Notice.Register(Usd.Notice.ObjectsChanged, self._on_objects_changed, stage)
+        # saving or reloading layers changes their dirty state (displayed on the graph) without changing stage objects
+        self._dirtiness_listener = Tf.Notice.RegisterGlobally(Sdf.Notice.LayerDirtinessChanged, self._on_layer_dirtiness_changed)
+        self._graph_info_request = request = object()
+        compute = _LayerStackGraphCompute(stage, prim_paths, self._graph_view.url_id_prefix, request)
+        self._graph_info_pending_key = graph_info_key
+        compute.signals.result.connect(self._on_graph_info_computed)
+        _core._run_holding_user_input(self._threadpool, compute, compute.signals.finished)
+
+    def _on_graph_info_computed(self, request, graph_info):
+        if request is not self._graph_info_request:  # superseded by a later request, already queued when it was made
+            return
+        self._graph_info_key, self._graph_info_pending_key = self._graph_info_pending_key, None
+        self._graph_info_request = None
         self._update_graph_from_graph_info(graph_info)
 
+    def _on_objects_changed(self, notice, sender):
+        # also when changed while computing, so the upcoming result is not re-used
+        self._graph_info_key = self._graph_info_pending_key = None
+
+    def _on_layer_dirtiness_changed(self, notice, sender):
+        graph_info = self._computed_graph_info
+        if not graph_info or sender in graph_info.ids_by_layers:  # other layers are not on the graph
+            self._on_objects_changed(notice, sender)
+
     def setPrimPaths(self, value):
         self._prim_paths_to_compute = {p if isinstance(p, Sdf.Path) else Sdf.Path(p) for p in value}
 
     def _update_graph_from_graph_info(self, graph_info: _GraphInfo):
+        if not graph_info:  # no stage yet, or still being computed
+            return
         self._computed_graph_info = graph_info
         # https://stackoverflow.com/questions/33262913/networkx-move-edges-in-nx-multidigraph-plot
         graph = nx.MultiDiGraph()
@@ -1112,12 +1465,17 @@ class LayerStackComposition(QtWidgets.QDialog):
         # self._graph_view.view(self._graph_view._viewing.intersection(graph_info.nodes))
 
     def _iedges(self, graph_info: _GraphInfo):
-        checked_arcs = {arc for arc, control in self._graph_edge_include.items() if control.isChecked()}
+        checked_arcs = frozenset(arc for arc, control in self._graph_edge_include.items() if control.isChecked())
         precise_ports = self._graph_precise_source_ports.isChecked()
+        sticky_nodes = frozenset(graph_info.sticky_nodes)
         for (src, tgt), edge_info in graph_info.edges.items():
+            # all arcs between sticky nodes are visible, so the check is done once per edge instead of once per arc
+            sticky = src in sticky_nodes and tgt in sticky_nodes
+            if not sticky and checked_arcs.isdisjoint(arc for arcs in edge_info.values() for arc in arcs):
+                continue
             arc_ports = edge_info if precise_ports else {None: collections.ChainMap(*edge_info.values())}
             for src_port, arcs in arc_ports.items():
-                visible_arcs = {arc: attrs for arc, attrs in arcs.items() if (arc in checked_arcs or {src, tgt}.issubset(graph_info.sticky_nodes))}
+                visible_arcs = arcs if sticky else {arc: attrs for arc, attrs in arcs.items() if arc in checked_arcs}
                 if visible_arcs:
                     # Composition arcs target layer stacks, so we don't specify port on our target nodes
                     ports = {"tailport": src_port} if precise_ports and src_port is not None else {}
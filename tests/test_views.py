@@ -3,9 +3,13 @@ import io
 import csv
 import shutil
 import tempfile
+import threading
+from pathlib import Path
 import unittest
 from unittest import mock
 
+import networkx as nx
+
 from pxr import Usd, UsdGeom, Sdf, UsdShade
 
 from grill import cook, usd, names
@@ -44,6 +48,17 @@ QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_ShareOpenGLContexts)
 # Ran 18 tests in 8.216s
 
 
+def _wait_for_selection(widget):
+    """Layer selection updates on LayerStackComposition are coalesced, wait for them to be processed."""
+    _qt.QtTest.QTest.qWait(widget._selection_timer.interval() * 2)
+
+
+def _wait_for_composition(widget):
+    """Composition widgets compute in a separate thread, wait for their result to be displayed."""
+    widget._threadpool.waitForDone(10_000)
+    QtWidgets.QApplication.processEvents()
+
+
 class TestPrivate(unittest.TestCase):
     def test_common_paths(self):
         input_paths = [
@@ -84,6 +99,41 @@ class TestPrivate(unittest.TestCase):
     def test_core(self):
         _core._ensure_dot()
 
+    def test_highlight_patterns(self):
+        cases = (
+            (description._HIGHLIGHT_PATTERN, '    def Sphere "b" (', [{'specifier': 'def', 'prim_type': 'Sphere', 'prim_name': '"b"'}]),
+            (description._HIGHLIGHT_PATTERN, '        prepend references = </b>', [
+                {'list_op': 'prepend', 'arc': 'references', 'value_assignment': '= '},
+                {'relationship': '</b>'},
+            ]),
+            (description._HIGHLIGHT_PATTERN, '    custom uniform float3[] f = [(1, 2.5)]', [
+                {'custom_meta': 'custom ', 'interpolation_meta': 'uniform ', 'prop_type': 'float3', 'prop_array': '[]', 'prop_name': 'f', 'value_assignment': '= '},
+                {'number': '1'},
+                {'number': '2.5'},
+            ]),
+            (description._HIGHLIGHT_PATTERN, '    asset a = @x.usd@</c>', [
+                {'prop_type': 'asset', 'prop_name': 'a', 'value_assignment': '= '},
+                {'identifier': '@x.usd@', 'identifier_prim_path': '</c>'},
+            ]),
+            (description._OUTLINE_SDF_PATTERN, '  </a/b> : def', [{'identifier_prim_path': '  </a/b>', 'specifier': 'def'}]),
+            (description._OUTLINE_SDF_PATTERN, '  targetPaths: [ /a/b ]', [{'metadata': 'targetPaths', 'relationship': '/a/b'}]),
+            (description._TREE_PATTERN, '     `--b [def Sphere] (kind = component)', [
+                {'identifier_prim_path': '     `--b', 'specifier': 'def', 'prim_type': 'Sphere', 'custom_meta': 'kind = component'},
+            ]),
+        )
+        for pattern, text, expected in cases:
+            with self.subTest(text=text):
+                actual = [{k: v for k, v in match.groupdict().items() if v} for match in pattern.finditer(text)]
+                self.assertEqual(expected, actual)
+
+        # only the groups of the branch that matched are inspected
+        pattern = description._HIGHLIGHT_PATTERN
+        groups_by_index = description._syntax_groups(pattern, description._HIGHLIGHT_BRANCHES)
+        for name, expected in (("identifier_prim_path", ["identifier", "identifier_prim_path"]), ("number", ["number"])):
+            with self.subTest(group=name):
+                self.assertEqual(expected, [group for __, group, __ in groups_by_index[pattern.groupindex[name]]])
+        self.assertEqual(len(pattern.groupindex), len(groups_by_index))
+
 
 class TestViews(unittest.TestCase):
     def setUp(self):
@@ -120,6 +170,11 @@ class TestViews(unittest.TestCase):
 
         self._tmpf = tempfile.mkdtemp()
         self._token = cook.Repository.set(cook.Path(self._tmpf) / "repo")
+        # svgs rendered by previous tests or sessions must not hide broken renders
+        self._svg_cache_dir = Path(self._tmpf) / "svg"
+        self._svg_cache_dir.mkdir()
+        self._svg_cache_patch = mock.patch("grill.views._graph._svg_cache_dir", return_value=self._svg_cache_dir)
+        self._svg_cache_patch.start()
         self.rootf = names.UsdAsset.get_anonymous()
         self.grill_world = gworld = cook.fetch_stage(self.rootf.name)
         self.person = cook.define_taxon(gworld, "Person")
@@ -128,6 +183,8 @@ class TestViews(unittest.TestCase):
 
     def tearDown(self) -> None:
         cook.Repository.reset(self._token)
+        self._svg_cache_patch.stop()
+        _graph._svg_renderer.cache_clear()  # tests might have rendered through mocked programs
         # Reset all members to USD objects to ensure the used layers are cleared
         # (otherwise in Windows this can cause failure to remove the temporary files)
         self.generic_agent = None
@@ -188,6 +245,7 @@ class TestViews(unittest.TestCase):
     def _sub_test_scenegraph_composition(self):
         widget = description.LayerStackComposition()
         widget.setStage(self.world)
+        _wait_for_composition(widget)
 
         # cheap. All these layers affect a single prim
         affectedPaths = dict.fromkeys((i.GetRootLayer() for i in (self.capsule, self.sphere, self.merge)), 1)
@@ -198,18 +256,27 @@ class TestViews(unittest.TestCase):
         for row in range(widget._layers.model.rowCount()):
             layer = widget._layers.model._objects[row]
             widget._layers.table.selectRow(row)
+            _wait_for_selection(widget)
             expectedAffectedPrims = affectedPaths[layer]
             actualListedPrims = widget._prims.model.rowCount()
             self.assertEqual(expectedAffectedPrims, actualListedPrims)
 
         widget._layers.table.selectAll()
+        _wait_for_selection(widget)
         self.assertEqual(len(affectedPaths), widget._layers.model.rowCount())
         self.assertEqual(3, widget._prims.model.rowCount())
 
+        graph_info = widget._computed_graph_info
+        widget.setStage(self.world)  # same stage, no changes: computed graph is re-used
+        self.assertIs(graph_info, widget._computed_graph_info)
+
         widget.setPrimPaths({"/nested/sibling"})
         widget.setStage(self.world)
+        _wait_for_composition(widget)
+        self.assertIsNot(graph_info, widget._computed_graph_info)
 
         widget._layers.table.selectAll()
+        _wait_for_selection(widget)
         self.assertEqual(2, widget._layers.model.rowCount())
         self.assertEqual(1, widget._prims.model.rowCount())
 
@@ -224,9 +291,25 @@ class TestViews(unittest.TestCase):
             widget._graph_view.view([0,1])
 
         _core._which.cache_clear()
-        with mock.patch("grill.views.description.nx.nx_agraph.write_dot") as patch:  # simulate pygraphviz is not installed
-            patch.side_effect = ImportError
-            widget._graph_view.view([0])
+        if isinstance(graph_view := widget._graph_view, _graph._GraphSVGViewer):
+            def _wait_for_renders():  # requests made while another one is rendered start after it
+                while graph_view._dot2svg:
+                    graph_view._threadpool.waitForDone(10_000)
+                    QtWidgets.QApplication.processEvents()
+
+            dot_error = "Error: <stdin>: syntax error in line 1"
+            _wait_for_renders()
+            _graph._dot_source_2_svg.cache_clear()
+            graph_view._dot_source = None  # render again, even if already displayed
+            # simulate dot failing to render, without pygraphviz installed
+            with mock.patch("grill.views._graph._agraph_cls", return_value=None), mock.patch("grill.views._graph._core._which", return_value="dot"), mock.patch("grill.views._graph._core._run", return_value=(dot_error, "")):
+                graph_view.view([0])
+                _wait_for_renders()
+            self.assertFalse(graph_view._error_view.isHidden())
+            self.assertEqual(dot_error, graph_view._error_view.toPlainText())
+            graph_view.view([0])  # requesting the failed source again retries it
+            self.assertTrue(graph_view._dot2svg)
+            _wait_for_renders()
 
         widget.deleteLater()
 
@@ -250,7 +333,31 @@ class TestViews(unittest.TestCase):
 
         widget = description.LayerStackComposition()
         widget.setStage(parent_stage)
+        _wait_for_composition(widget)
         widget._layers.table.selectAll()
+        _wait_for_selection(widget)
+
+        graph_info = widget._computed_graph_info
+        parent_stage.DefinePrim("/a/c")  # stage changes invalidate the computed graph
+        widget.setStage(parent_stage)
+        _wait_for_composition(widget)
+        self.assertIsNot(graph_info, widget._computed_graph_info)
+
+        parent_stage.DefinePrim("/a/d")  # changes after the graph is computed invalidate it
+        self.assertIsNone(widget._graph_info_key)
+        widget.setStage(parent_stage)  # user input (which could edit the stage) is held until the graph is computed
+        self.assertIsNotNone(widget._graph_info_key)
+        widget._on_graph_info_computed(object(), graph_info)  # results from superseded requests are ignored
+        self.assertIsNot(graph_info, widget._computed_graph_info)
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            sublayer = Sdf.Layer.CreateNew(str(Path(tmpdirname) / "sublayer.usda"))
+            parent_stage.GetRootLayer().subLayerPaths.append(sublayer.identifier)
+            Sdf.CreatePrimInLayer(sublayer, "/a")
+            widget.setStage(parent_stage)
+            self.assertIsNotNone(widget._graph_info_key)
+            sublayer.Save()  # dirty layers are displayed differently, but saving them does not change stage objects
+            self.assertIsNone(widget._graph_info_key)
 
         graph_view = widget._graph_view
 
@@ -271,10 +378,12 @@ class TestViews(unittest.TestCase):
 
         widget = description.LayerStackComposition()
         widget.setStage(parent_stage)
+        _wait_for_composition(widget)
         widget._graph_precise_source_ports.setChecked(True)
         widget._has_specs.setCheckState(QtCore.Qt.CheckState.PartiallyChecked)
 
         widget._layers.table.selectAll()
+        _wait_for_selection(widget)
         graph_view = widget._graph_view
         cycle_collected = False
         nodes_hovered_checked = False
@@ -326,14 +435,16 @@ class TestViews(unittest.TestCase):
         prim = temp.GetPrimAtPath(self.nested.GetPath())
         widget = description.PrimComposition()
         widget.setPrim(prim)
+        _wait_for_composition(widget)
 
         # cheap. prim is affected by 2 layers
         # single child for this prim.
-        self.assertTrue(widget.composition_tree._model.invisibleRootItem().hasChildren())
+        self.assertTrue(widget.composition_tree._model.hasChildren())
 
         widget._complete_target_layerstack.setChecked(True)
         widget.setPrim(prim)
-        self.assertTrue(widget.composition_tree._model.invisibleRootItem().hasChildren())
+        _wait_for_composition(widget)
+        self.assertTrue(widget.composition_tree._model.hasChildren())
 
         with mock.patch("grill.views.description.QtWidgets.QApplication.keyboardModifiers") as patch:
             patch.return_value = QtCore.Qt.ShiftModifier
@@ -342,7 +453,9 @@ class TestViews(unittest.TestCase):
             widget.composition_tree.collapsed.emit(root_idx)
 
         widget.setPrim(None)
-        self.assertFalse(widget.composition_tree._model.invisibleRootItem().hasChildren())
+        self.assertFalse(widget.composition_tree._model.hasChildren())
+        widget._on_prim_index_dumped(object(), ("", "", []))  # results from superseded requests are ignored
+        self.assertFalse(widget.composition_tree._model.hasChildren())
 
         widget.clear()
 
@@ -590,6 +703,36 @@ class TestViews(unittest.TestCase):
         widget.model._prune_children = {over.GetPath()}
         widget.setStage(stage)
 
+    def test_run_holding_user_input(self):
+        class Signals(QtCore.QObject):
+            finished = QtCore.Signal()
+
+        class Runnable(QtCore.QRunnable):
+            def __init__(self, wait_for_timer):
+                super().__init__()
+                self.signals = Signals()
+                self.timer_fired = threading.Event()
+                self._wait_for_timer = wait_for_timer
+
+            def run(self):
+                try:
+                    if self._wait_for_timer:
+                        self.timer_fired.wait(5)
+                finally:
+                    self.signals.finished.emit()
+
+        threadpool = QtCore.QThreadPool()
+        for wait_for_timer in (True, False):
+            with self.subTest(wait_for_timer=wait_for_timer):
+                runnable = Runnable(wait_for_timer)
+                runnable.setAutoDelete(False)
+                QtCore.QTimer.singleShot(0, runnable.timer_fired.set)
+                # returns once finished, even when emitted before the nested loop starts
+                _core._run_holding_user_input(threadpool, runnable, runnable.signals.finished)
+                self.assertTrue(threadpool.waitForDone(5000))
+                if wait_for_timer:  # non user input events keep being processed while holding
+                    self.assertTrue(runnable.timer_fired.is_set())
+
     def test_dot_call(self):
         """Test execution of function by mocking dot with python call"""
         with mock.patch("grill.views.description._which") as patch:
@@ -598,6 +741,119 @@ class TestViews(unittest.TestCase):
             # an error would be reported back
             self.assertIsNotNone(error)
 
+    def test_dot_source_via_pygraphviz(self):
+        """pygraphviz renders in-process, so dot is not needed on the PATH."""
+        _graph._dot_source_2_svg.cache_clear()
+        converter = _graph._DotSource2Svg("digraph {}")
+        results, errors = [], []
+        converter.signals.result.connect(results.append)
+        converter.signals.error.connect(errors.append)
+        with mock.patch("grill.views._graph._agraph_cls", return_value=object), mock.patch("grill.views._graph._core._which", return_value=None), mock.patch("grill.views._graph._agraph_2_svg", return_value=(None, "<svg/>")):
+            converter.run()
+        _graph._dot_source_2_svg.cache_clear()
+        self.assertEqual((["<svg/>"], []), (results, errors))
+
+    def test_kept_edges(self):
+        view = _graph.GraphView()
+        view._graph = nx.MultiDiGraph([(1, 2), (2, 3)])
+        view.filter_edges = lambda source, target, *_: source == 1
+        self.assertEqual({(1, 2, 0)}, _graph._kept_edges(view))
+        view.sticky_nodes.append(3)  # edited in place, edges to sticky nodes are kept from now on
+        self.assertEqual({(1, 2, 0), (2, 3, 0)}, _graph._kept_edges(view))
+        view._graph = nx.MultiDiGraph([(1, 4)])
+        self.assertEqual({(1, 4, 0)}, _graph._kept_edges(view))
+
+    def test_svg_cache(self):
+        source = "digraph { cached }"
+        _graph._dot_source_2_svg.cache_clear()
+        with mock.patch("grill.views._graph._agraph_cls", return_value=None), mock.patch("grill.views._graph._svg_renderer", return_value="dot test"):
+            with mock.patch("grill.views._graph._core._run", return_value=(None, "<svg/>")) as run:
+                self.assertEqual((None, "<svg/>"), _graph._dot_source_2_svg(source))
+            self.assertEqual(1, run.call_count)
+            self.assertEqual(["<svg/>"], [path.read_text() for path in self._svg_cache_dir.glob("*.svg")])
+            _graph._dot_source_2_svg.cache_clear()  # as in a new session
+            with mock.patch("grill.views._graph._core._run") as run:
+                self.assertEqual((None, "<svg/>"), _graph._dot_source_2_svg(source))
+            run.assert_not_called()
+        _graph._dot_source_2_svg.cache_clear()
+
+    def test_svg_cache_prune(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            cache_dir = Path(tmpdirname)
+            for mtime, name in enumerate(("oldest", "older", "newest"), start=1):
+                path = cache_dir / f"{name}.svg"
+                path.write_text("0" * 10)
+                os.utime(path, (mtime, mtime))
+            (cache_dir / "interrupted.1.2.tmp").touch()
+            os.utime(cache_dir / "interrupted.1.2.tmp", (1, 1))
+            (cache_dir / "writing.1.2.tmp").touch()
+            _graph._prune_svg_cache(cache_dir, 25)
+            self.assertEqual({"older.svg", "newest.svg", "writing.1.2.tmp"}, {path.name for path in cache_dir.iterdir()})
+
+    def test_svg_renderer(self):
+        svg = "<!-- Generated by graphviz version 12.2.1 (20241206.2353)\n -->\n<svg/>"
+        _graph._svg_renderer.cache_clear()
+        with mock.patch("grill.views._graph._agraph_cls", return_value=None), mock.patch("grill.views._graph._core._run", return_value=(None, svg)):
+            # cached svgs are keyed by it, so they're not re-used after upgrading graphviz
+            self.assertEqual("dot 12.2.1 (20241206.2353)", _graph._svg_renderer())
+        _graph._svg_renderer.cache_clear()
+
+    def test_format_layer_contents_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdirname, mock.patch.dict(description._LAYER_CONTENTS_CACHE, clear=True):
+            layer = Sdf.Layer.CreateNew(str(Path(tmpdirname) / "cached.usda"))
+            layer.Save()
+            with mock.patch("grill.views.description._core._run", return_value=(None, "contents")) as run:
+                description._format_layer_contents(layer)
+                description._format_layer_contents(layer)
+                # unchanged layer contents are formatted once
+                self.assertEqual(1, run.call_count)
+                description._format_layer_contents(layer, "outline")
+                self.assertEqual(2, run.call_count)
+                Sdf.CreatePrimInLayer(layer, "/changed")
+                description._format_layer_contents(layer)  # in-memory edits are formatted again
+                self.assertEqual(3, run.call_count)
+                on_disk = Sdf.Layer.CreateAnonymous()
+                Sdf.CreatePrimInLayer(on_disk, "/on_disk")
+                on_disk.Export(layer.realPath)
+                layer.Reload(force=True)
+                description._format_layer_contents(layer)  # so are contents re-loaded from disk
+                self.assertEqual(4, run.call_count)
+            with mock.patch("grill.views.description._core._run", return_value=("failed", "")) as run:
+                description._format_layer_contents(layer, "validity")
+                description._format_layer_contents(layer, "validity")
+                # errors are not kept, so the next request tries again
+                self.assertEqual(2, run.call_count)
+
+    def test_highlight_visible_blocks(self):
+        browser = QtWidgets.QTextBrowser()
+        browser.setLineWrapMode(QtWidgets.QTextBrowser.NoWrap)
+        highlighter = description._Highlighter(browser)
+        line_count = highlighter._LAZY_BLOCK_COUNT * 2
+        browser.setText("\n".join(f'def "prim_{each}"' for each in range(line_count)))
+        document = browser.document()
+        formats = lambda number: document.findBlockByNumber(number).layout().formats()
+        # big contents are highlighted only around the visible area
+        self.assertTrue(formats(0))
+        self.assertFalse(formats(line_count - 1))
+        browser.moveCursor(QtGui.QTextCursor.End)  # scroll to the bottom
+        self.assertTrue(formats(line_count - 1))
+        self.assertFalse(formats(line_count // 2))
+
+    def test_identifier_click(self):
+        browser = description._PseudoUSDTabBrowser()
+        browser.setText('    prepend references = [@first.usda@, @second.usda@</prim>]')
+        browser.resize(800, 100)
+        browser.show()
+        requested = []
+        browser.identifier_requested.connect(requested.append)
+        block = browser.document().firstBlock()
+        for column, expected in ((8, []), (block.text().index("second") + 2, ["second.usda"])):
+            cursor = QtGui.QTextCursor(block)
+            cursor.setPosition(block.position() + column)
+            position = browser.cursorRect(cursor).center()
+            _qt.QtTest.QTest.mouseClick(browser.viewport(), QtCore.Qt.LeftButton, pos=position)
+            self.assertEqual(expected, requested)
+
     def test_content_browser(self):
         stage = cook.fetch_stage(self.rootf)
         taxon = cook.define_taxon(stage, "Another")
@@ -643,6 +899,9 @@ class TestViews(unittest.TestCase):
             first_browser_widget._format_options.setCurrentIndex(0)
 
             browser_tab: description._PseudoUSDTabBrowser = first_browser_widget.findChild(description._PseudoUSDTabBrowser)
+            # previous highlighters are detached when switching formats
+            highlighters = [each for each in browser_tab.findChildren(QtGui.QSyntaxHighlighter) if each.document()]
+            self.assertEqual([description._Highlighter], [type(each) for each in highlighters])
             browser._on_identifier_requested(anchor, layers[1].identifier)
             with mock.patch(f"{QtWidgets.__name__}.QMessageBox.warning", new=_log):
                 browser._on_identifier_requested(anchor, "/missing/file.usd")
@@ -673,7 +932,8 @@ class TestViews(unittest.TestCase):
             event = QtGui.QWheelEvent(position, position, pixelDelta, angleDelta_zoomOut, buttons, modifiers, phase, inverted)
             browser_tab.wheelEvent(event)
 
-            browser._close_many(range(len(browser._tab_layer_by_idx)))
+            browser._close_many(range(browser.count()))
+            self.assertFalse(browser._browsers_by_layer)
             for child in dialog.findChildren(description._PseudoUSDBrowser):
                 child._resolved_layers.clear()
 